@@ -2,11 +2,12 @@ from django.conf import settings
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.sites.models import Site
 from django.contrib.sites.shortcuts import get_current_site
-from django.core.mail import EmailMultiAlternatives
 from django.urls import reverse
 from django.utils.encoding import force_bytes
 from django.utils.http import urlsafe_base64_encode
 
+from outbox.utils import queue_email
+
 from .tokens import activation_token
 
 domain = Site.objects.get_current().domain
@@ -34,10 +35,7 @@ def send_verification_email(request, user):
         + activation_link
     )
     from_email = settings.DEFAULT_FROM_EMAIL
-    msg = EmailMultiAlternatives(
-        subject, body, f"{domain} <{from_email}>", [user.email]
-    )
-    msg.send(fail_silently=False)
+    queue_email(subject, body, f"{domain} <{from_email}>", [user.email])
 
 
 def send_verification_email_for_change_email(request, email):
@@ -60,10 +58,7 @@ def send_verification_email_for_change_email(request, email):
         + activation_link
     )
     from_email = settings.DEFAULT_FROM_EMAIL
-    msg = EmailMultiAlternatives(
-        subject, body, f"{domain} <{from_email}>", [user.email]
-    )
-    msg.send(fail_silently=False)
+    queue_email(subject, body, f"{domain} <{from_email}>", [user.email])
 
 
 def send_reset_password_email(request, user):
@@ -83,7 +78,4 @@ def send_reset_password_email(request, user):
         + activation_link
     )
     from_email = settings.DEFAULT_FROM_EMAIL
-    msg = EmailMultiAlternatives(
-        subject, body, f"{domain} <{from_email}>", [user.email]
-    )
-    msg.send(fail_silently=False)
+    queue_email(subject, body, f"{domain} <{from_email}>", [user.email])
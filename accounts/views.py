@@ -1,5 +1,6 @@
 from django.conf import settings
 from django.contrib.auth.tokens import default_token_generator
+from django.db import transaction
 from django.http import Http404
 from django.shortcuts import redirect
 from django.utils.encoding import force_str
@@ -35,8 +36,10 @@ class SignUpView(APIView):
         serializer = CreateUserSerializer(data=request.data)
 
         if serializer.is_valid():
-            user = serializer.save(is_active=False)
-            send_verification_email(request, user)
+            # the verification email is queued only if the user commits
+            with transaction.atomic():
+                user = serializer.save(is_active=False)
+                send_verification_email(request, user)
 
             return Response(
                 {"success": "User created Successfully"}, status=status.HTTP_201_CREATED
@@ -61,8 +64,10 @@ class SellerSignUpView(APIView):
 
         serializer = CreateUserSerializer(data=request.data)
         if serializer.is_valid():
-            user = serializer.save(role="seller", is_active=False)
-            send_verification_email(request, user)
+            # the verification email is queued only if the user commits
+            with transaction.atomic():
+                user = serializer.save(role="seller", is_active=False)
+                send_verification_email(request, user)
 
             return Response(
                 {"success": "User created Successfully"}, status=status.HTTP_201_CREATED
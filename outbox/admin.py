@@ -0,0 +1,9 @@
+from django.contrib import admin
+
+from .models import OutboxEmail
+
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ["subject", "status", "attempts", "send_after", "sent_at"]
+    list_filter = ["status"]
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from outbox.utils import BATCH_SIZE, drain_outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Send the queued emails of the outbox, once or, with --loop, "
+        "polling every --interval seconds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+        parser.add_argument("--loop", action="store_true")
+        parser.add_argument("--interval", type=float, default=5)
+
+    def handle(self, *args, **options):
+        while True:
+            count = drain_outbox(options["batch_size"])
+            if count:
+                self.stdout.write(f"Attempted {count} emails")
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
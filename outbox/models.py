@@ -0,0 +1,39 @@
+from django.db import models
+from django.utils import timezone
+
+OUTBOX_STATUS = (
+    ("pending", "Pending"),
+    ("sending", "Sending"),
+    ("sent", "Sent"),
+    ("failed", "Failed"),
+)
+
+
+class OutboxEmail(models.Model):
+    """
+    An email waiting to be sent by ``send_outbox``. Rows are written in
+    the transaction of the change they announce, so an email is queued
+    if and only if that change commits.
+    """
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    to = models.JSONField()
+    status = models.CharField(max_length=20, choices=OUTBOX_STATUS, default="pending")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # when a pending email is due, or when the lease of a worker sending
+    # it runs out and another worker may claim it again
+    send_after = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # the worker's queue: due pending emails and expired leases
+            models.Index(fields=["status", "send_after"], name="outbox_due_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.to)}"
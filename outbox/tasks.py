@@ -0,0 +1,8 @@
+from celery import shared_task
+
+from .utils import drain_outbox
+
+
+@shared_task
+def send_outbox_task():
+    return drain_outbox()
@@ -0,0 +1,157 @@
+from datetime import timedelta
+from smtplib import SMTPException
+from unittest import mock
+
+from django.core import mail
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from kombu.exceptions import OperationalError
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from .models import OutboxEmail
+from .utils import (
+    LEASE_TIME,
+    MAX_ATTEMPTS,
+    RETRY_DELAY,
+    dispatch_outbox,
+    queue_email,
+    send_outbox,
+)
+
+
+class OutboxTests(TestCase):
+    def queue(self, count=1):
+        for number in range(count):
+            queue_email(f"subject {number}", "body", "shop <shop@email.com>", ["a@b.c"])
+
+    def test_email_is_queued_with_the_transaction(self):
+        with transaction.atomic():
+            self.queue()
+            transaction.set_rollback(True)
+        self.assertFalse(OutboxEmail.objects.exists())
+
+        self.queue()
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_send_batches_over_one_connection(self):
+        self.queue(3)
+
+        with mock.patch(
+            "outbox.utils.get_connection", wraps=mail.get_connection
+        ) as get_connection:
+            self.assertEqual(send_outbox(batch_size=2), 2)
+            self.assertEqual(send_outbox(batch_size=2), 1)
+            self.assertEqual(send_outbox(batch_size=2), 0)
+
+        self.assertEqual(get_connection.call_count, 2)
+        self.assertEqual(
+            [email.subject for email in mail.outbox],
+            ["subject 0", "subject 1", "subject 2"],
+        )
+        self.assertEqual(OutboxEmail.objects.filter(status="sent").count(), 3)
+
+    def test_failed_email_is_retried_with_backoff(self):
+        self.queue()
+        send_messages = mock.Mock(side_effect=SMTPException("unavailable"))
+
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            send_messages,
+        ):
+            self.assertEqual(send_outbox(), 1)
+            email = OutboxEmail.objects.get()
+            self.assertEqual(email.status, "pending")
+            self.assertIn("unavailable", email.last_error)
+            self.assertGreater(email.send_after, timezone.now())
+            # not due again until the backoff passes
+            self.assertEqual(send_outbox(), 0)
+
+            for attempt in range(2, MAX_ATTEMPTS + 1):
+                OutboxEmail.objects.update(send_after=timezone.now())
+                send_outbox()
+
+        email.refresh_from_db()
+        self.assertEqual(email.attempts, MAX_ATTEMPTS)
+        self.assertEqual(email.status, "failed")
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_emails_are_leased_while_sending(self):
+        self.queue()
+        statuses = []
+
+        def send_messages(messages):
+            statuses.append(OutboxEmail.objects.get().status)
+            return len(messages)
+
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            side_effect=send_messages,
+        ):
+            send_outbox()
+
+        self.assertEqual(statuses, ["sending"])
+        self.assertEqual(OutboxEmail.objects.get().status, "sent")
+
+    def test_expired_lease_is_claimed_again(self):
+        self.queue(2)
+        now = timezone.now()
+        OutboxEmail.objects.filter(subject="subject 0").update(
+            status="sending", send_after=now - timedelta(seconds=1)
+        )
+        OutboxEmail.objects.filter(subject="subject 1").update(
+            status="sending", send_after=now + timedelta(seconds=LEASE_TIME)
+        )
+
+        self.assertEqual(send_outbox(), 1)
+        self.assertEqual([email.subject for email in mail.outbox], ["subject 0"])
+
+    @override_settings(CELERY_BROKER_URL="amqp://broker")
+    def test_broker_errors_are_logged(self):
+        with mock.patch(
+            "outbox.tasks.send_outbox_task.delay",
+            side_effect=OperationalError("connection refused"),
+        ), self.assertLogs("outbox.utils", "WARNING"):
+            dispatch_outbox()
+
+    def test_backoff_doubles(self):
+        self.queue()
+
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.open",
+            side_effect=SMTPException("connection refused"),
+        ):
+            for attempt in range(1, 3):
+                started = timezone.now()
+                OutboxEmail.objects.update(send_after=started)
+                send_outbox()
+                email = OutboxEmail.objects.get()
+                delay = timedelta(seconds=RETRY_DELAY * 2 ** (attempt - 1))
+                self.assertGreaterEqual(email.send_after, started + delay)
+                self.assertEqual(email.attempts, attempt)
+
+
+class OutboxCommandTests(APITestCase):
+    def test_signup_email_is_sent_by_the_worker(self):
+        data = {
+            "first_name": "Khaled",
+            "last_name": "Nur",
+            "username": "khaled",
+            "email": "khaled@email.com",
+            "password": "12345!@#$",
+            "password2": "12345!@#$",
+        }
+        response = self.client.post(
+            reverse("accounts:buyer_signup"), data, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(mail.outbox), 0)
+
+        call_command("send_outbox", stdout=mock.Mock())
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["khaled@email.com"])
+        self.assertEqual(mail.outbox[0].subject, "Account Verification")
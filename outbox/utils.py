@@ -0,0 +1,134 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+from kombu.exceptions import OperationalError
+
+from .models import OutboxEmail
+
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 60  # in seconds, doubled after every failed attempt
+LEASE_TIME = 600  # in seconds a worker has to send the emails it claimed
+
+logger = logging.getLogger(__name__)
+
+
+def queue_email(subject, body, from_email, to):
+    """
+    Queue an email in the current transaction instead of sending it, so
+    no SMTP round trip is spent in the request and the email goes out
+    only if the transaction commits.
+    """
+    email = OutboxEmail.objects.create(
+        subject=subject, body=body, from_email=from_email, to=list(to)
+    )
+    transaction.on_commit(dispatch_outbox)
+    return email
+
+
+def dispatch_outbox():
+    # with a broker, a Celery worker sends the email right away; otherwise,
+    # or if the broker is down, the send_outbox command picks it up
+    if not getattr(settings, "CELERY_BROKER_URL", None):
+        return
+    from .tasks import send_outbox_task
+
+    try:
+        send_outbox_task.delay()
+    except OperationalError:
+        logger.warning("Could not dispatch the outbox to Celery", exc_info=True)
+
+
+def claim_emails(batch_size):
+    """
+    Lease up to ``batch_size`` due emails to this worker for ``LEASE_TIME``
+    seconds, in a short transaction of its own. Emails of a worker that
+    died while holding them are due again once their lease runs out.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(
+            OutboxEmail.objects.select_for_update(skip_locked=True)
+            .filter(status__in=["pending", "sending"], send_after__lte=now)
+            .order_by("send_after")[:batch_size]
+        )
+        lease = now + timedelta(seconds=LEASE_TIME)
+        OutboxEmail.objects.filter(pk__in=[email.pk for email in emails]).update(
+            status="sending", send_after=lease
+        )
+    return emails
+
+
+def send_outbox(batch_size=BATCH_SIZE, max_attempts=MAX_ATTEMPTS):
+    """
+    Send up to ``batch_size`` due emails over one SMTP connection.
+    Failed emails are retried after ``RETRY_DELAY`` seconds, doubling per
+    attempt, and marked failed after ``max_attempts``. Returns how many
+    emails were attempted.
+
+    The emails are claimed and their results saved in two short
+    transactions, so no rows stay locked while talking to the SMTP server
+    and several workers can drain the outbox side by side. Sending is at
+    least once: if a worker dies before saving its results, the emails it
+    sent are sent again after their lease runs out.
+    """
+    emails = claim_emails(batch_size)
+    if not emails:
+        return 0
+
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except Exception as error:
+        for email in emails:
+            retry_email(email, error, max_attempts)
+    else:
+        try:
+            for email in emails:
+                message = EmailMultiAlternatives(
+                    email.subject, email.body, email.from_email, email.to
+                )
+                try:
+                    connection.send_messages([message])
+                except Exception as error:
+                    retry_email(email, error, max_attempts)
+                else:
+                    email.attempts += 1
+                    email.status = "sent"
+                    email.sent_at = timezone.now()
+        finally:
+            connection.close()
+
+    with transaction.atomic():
+        OutboxEmail.objects.bulk_update(
+            emails, ["status", "attempts", "last_error", "send_after", "sent_at"]
+        )
+    return len(emails)
+
+
+def retry_email(email, error, max_attempts):
+    email.attempts += 1
+    email.last_error = repr(error)
+    if email.attempts >= max_attempts:
+        email.status = "failed"
+    else:
+        email.status = "pending"
+        delay = RETRY_DELAY * 2 ** (email.attempts - 1)
+        email.send_after = timezone.now() + timedelta(seconds=delay)
+
+
+def drain_outbox(batch_size=BATCH_SIZE):
+    """
+    Send batches until no due email is left. Returns how many emails
+    were attempted.
+    """
+    total = 0
+    while count := send_outbox(batch_size):
+        total += count
+        if count < batch_size:
+            break
+    return total
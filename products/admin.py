@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import Cart, Category, Product, ProductImage
+from .checkout import refund
+from .models import Cart, Category, Order, OrderItem, Product, ProductImage
 
 
 class ProductImageInline(admin.StackedInline):
@@ -16,5 +17,25 @@ class ProductAdmin(admin.ModelAdmin):
     ]
 
 
+class OrderItemInline(admin.TabularInline):
+    model = OrderItem
+    extra = 0
+
+
+@admin.register(Order)
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ["pk", "user", "status", "total", "created_at"]
+    list_filter = ["status"]
+    inlines = [
+        OrderItemInline,
+    ]
+    actions = ["refund_orders"]
+
+    @admin.action(description="Refund selected orders")
+    def refund_orders(self, request, queryset):
+        refunded = sum(refund(order) for order in queryset)
+        self.message_user(request, f"{refunded} orders refunded")
+
+
 admin.site.register(Category)
 admin.site.register(Cart)
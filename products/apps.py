@@ -6,4 +6,4 @@ class ProductsConfig(AppConfig):
     name = "products"
 
     def ready(self):
-        from products import signals
+        from products import checks, signals
@@ -0,0 +1,187 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Category, Product
+
+CATALOG_VERSION_KEY = "products:catalog:version"
+CATEGORY_VERSION_KEY = "products:category:version"
+CATEGORY_TREE_KEY = "products:category:tree"
+FACET_COUNTS_KEY = "products:facet_counts"
+PRODUCT_PAYLOAD_KEY = "products:product:{slug}:payload:{host}:{fieldset}:{version}"
+CACHE_TIMEOUT = 60 * 60 * 24
+# incremental adjustments are not atomic across processes, so the counts
+# are recomputed from scratch at least this often
+FACET_COUNTS_TIMEOUT = 60 * 10
+
+_facet_counts_lock = threading.Lock()
+
+# (version, paths) of the in-process breadcrumb map
+_category_paths = (None, {})
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls for the same key into one: the first caller
+    runs the function, the others wait for and share its result.
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+_single_flight = SingleFlight()
+
+
+def get_product_version_key(slug):
+    return f"products:product:{slug}:version"
+
+
+def _get_or_add(key, default, timeout):
+    value = cache.get(key)
+    if value is None:
+        value = default()
+        if not cache.add(key, value, timeout):
+            value = cache.get(key, value)
+    return value
+
+
+def get_version(key):
+    # start from the clock so a lost counter never reuses an old version
+    return _get_or_add(key, time.time_ns, settings.CACHE_VERSION_TIMEOUT)
+
+
+def get_modified(key):
+    """
+    Timestamp of the last ``bump_version`` of ``key``, or of the first
+    time it was asked for if that is unknown.
+    """
+    return _get_or_add(f"{key}:modified", time.time, settings.CACHE_VERSION_TIMEOUT)
+
+
+def bump_version(key):
+    timeout = settings.CACHE_VERSION_TIMEOUT
+    cache.set(f"{key}:modified", time.time(), timeout)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = time.time_ns()
+        cache.set(key, version, timeout)
+        return version
+
+
+def get_category_tree():
+    key = f"{CATEGORY_TREE_KEY}:{get_version(CATEGORY_VERSION_KEY)}"
+    tree = cache.get(key)
+    if tree is None:
+        tree = Category.objects.tree()
+        cache.set(key, tree, CACHE_TIMEOUT)
+    return tree
+
+
+def get_category_paths():
+    global _category_paths
+
+    version = get_version(CATEGORY_VERSION_KEY)
+    if _category_paths[0] != version:
+        _category_paths = (version, Category.objects.paths())
+    return _category_paths[1]
+
+
+def get_facet_counts():
+    entry = cache.get(FACET_COUNTS_KEY)
+    if entry is None or entry["built_at"] + FACET_COUNTS_TIMEOUT < time.time():
+        entry = {
+            "built_at": time.time(),
+            "counts": Product.published_objects.facet_counts(),
+        }
+        cache.set(FACET_COUNTS_KEY, entry, CACHE_TIMEOUT)
+    return entry["counts"]
+
+
+def adjust_facet_counts(old, new):
+    """
+    Move one product's contribution to the cached facet counts from the
+    ``old`` to the ``new`` facet values, either of which may be ``None``.
+    """
+    with _facet_counts_lock:
+        entry = cache.get(FACET_COUNTS_KEY)
+        if entry is None:
+            return
+
+        for values, delta in ((old, -1), (new, 1)):
+            for facet, value in (values or {}).items():
+                if not value:
+                    continue
+                bucket = entry["counts"][facet]
+                bucket[value] = bucket.get(value, 0) + delta
+                if bucket[value] <= 0:
+                    del bucket[value]
+        cache.set(FACET_COUNTS_KEY, entry, CACHE_TIMEOUT)
+
+
+def delete_facet_counts():
+    cache.delete(FACET_COUNTS_KEY)
+
+
+def get_product_payload(slug, host, build, fieldset=""):
+    """
+    Cached detail payload of the product at ``slug``, rebuilt with
+    ``build`` by a single thread per process when it is missing.
+    ``fieldset`` names the sparse fieldset the payload was rendered with.
+
+    The key embeds the product and category versions, so any write to the
+    product, its images or the category tree makes it unreachable.
+    """
+    version = (
+        f"{get_version(get_product_version_key(slug))}"
+        f"-{get_version(CATEGORY_VERSION_KEY)}"
+    )
+    key = PRODUCT_PAYLOAD_KEY.format(
+        slug=slug, host=host, fieldset=fieldset, version=version
+    )
+
+    def fill():
+        payload = cache.get(key)
+        if payload is None:
+            payload = build()
+            cache.set(key, payload, CACHE_TIMEOUT)
+        return payload
+
+    payload = cache.get(key)
+    if payload is None:
+        payload = _single_flight.do(key, fill)
+    return payload
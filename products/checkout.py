@@ -0,0 +1,137 @@
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from accounts.models import User
+
+from .models import Cart, Order, OrderItem, Product
+from .profiles import get_sales, update_profile_totals
+from .signals import products_stock_changed
+from .utils import send_mail_to_product_owner_for_out_of_stack_products
+
+
+class CheckoutError(Exception):
+    def __init__(self, detail):
+        super().__init__(detail)
+        self.detail = detail
+
+
+def checkout(user):
+    """
+    Turn ``user``'s cart into an order in one transaction.
+
+    Stock is taken with one conditional UPDATE per line,
+    ``quantity = quantity - n WHERE quantity >= n``, so concurrent
+    checkouts can't oversell a product without locking its table; rows
+    are updated in primary key order so they can't deadlock each other
+    either. The cart lines are locked as they are read and only those
+    lines are removed, so a line added meanwhile stays in the cart for
+    the next checkout. Raises ``CheckoutError`` with the unavailable product slugs,
+    after rolling back, when any line can't be served.
+    """
+    with transaction.atomic():
+        lines = list(
+            Cart.objects.filter(user=user, quantity__gte=1)
+            .select_for_update(of=("self",))
+            .order_by("product_id")
+            .values(
+                "pk",
+                "product_id",
+                "quantity",
+                "product__owner_id",
+                "product__slug",
+                "product__title",
+                "product__price",
+                "product__effective_price",
+            )
+        )
+        if not lines:
+            raise CheckoutError({"cart": ["Your cart is empty."]})
+
+        unavailable = []
+        for line in lines:
+            taken = Product.objects.filter(
+                pk=line["product_id"],
+                status="published",
+                quantity__gte=line["quantity"],
+            ).update(quantity=F("quantity") - line["quantity"])
+            if not taken:
+                unavailable.append(line["product__slug"])
+        if unavailable:
+            raise CheckoutError({"unavailable": unavailable})
+
+        products = Product.objects.filter(pk__in=[line["product_id"] for line in lines])
+        out_of_stock = products.mark_out_of_stock()
+        if settings.STOCK_DIGEST:
+            products.flag_stock_alerts()
+        elif out_of_stock:
+            notify_sellers(lines, out_of_stock)
+
+        order = create_order(user, lines)
+        sales = {}
+        for line in lines:
+            amount = line["product__effective_price"] * line["quantity"]
+            owner = line["product__owner_id"]
+            sales[owner] = sales.get(owner, 0) + amount
+        update_profile_totals(user.pk, order.total, sales)
+        Cart.objects.filter(pk__in=[line["pk"] for line in lines]).delete()
+
+    products_stock_changed.send(
+        sender=Product,
+        slugs=[line["product__slug"] for line in lines],
+        out_of_stock=bool(out_of_stock),
+    )
+    return order
+
+
+def refund(order):
+    """
+    Mark a placed ``order`` refunded and take it off the buyer and seller
+    totals. Returns False, changing nothing, if it was already refunded.
+    """
+    with transaction.atomic():
+        refunded = Order.objects.filter(pk=order.pk, status="placed").update(
+            status="refunded"
+        )
+        if not refunded:
+            return False
+        update_profile_totals(order.user_id, order.total, get_sales(order), True)
+    order.status = "refunded"
+    return True
+
+
+def create_order(user, lines):
+    subtotal = sum(line["product__price"] * line["quantity"] for line in lines)
+    total = sum(line["product__effective_price"] * line["quantity"] for line in lines)
+    order = Order.objects.create(
+        user=user, subtotal=subtotal, discount=subtotal - total, total=total
+    )
+    OrderItem.objects.bulk_create(
+        OrderItem(
+            order=order,
+            product_id=line["product_id"],
+            seller_id=line["product__owner_id"],
+            title=line["product__title"],
+            price=line["product__price"],
+            unit_price=line["product__effective_price"],
+            quantity=line["quantity"],
+        )
+        for line in lines
+    )
+    return order
+
+
+def notify_sellers(lines, out_of_stock):
+    # one email per seller, for all of their products this order sold out
+    owners = {line["product_id"]: line["product__owner_id"] for line in lines}
+    out_of_stock = sorted(
+        (owners[product["pk"]], product["title"]) for product in out_of_stock
+    )
+    sellers = User.objects.in_bulk({owner for owner, _ in out_of_stock})
+    for owner, products in groupby(out_of_stock, key=itemgetter(0)):
+        send_mail_to_product_owner_for_out_of_stack_products(
+            sellers[owner], [title for _, title in products]
+        )
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+PROCESS_LOCAL_CACHES = [
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+]
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Cache versions, ETags and the breadcrumb map are only invalidated for
+    every worker when they share the cache. Development servers, with
+    DEBUG on, run in one process and are left alone.
+    """
+    backend = settings.CACHES["default"]["BACKEND"]
+    if settings.DEBUG or backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [
+        Warning(
+            "The default cache is local to each process, so workers don't "
+            "see each other's cache invalidations.",
+            hint=(
+                "Run a single worker process, or set CACHE_BACKEND in "
+                "config.json to a shared cache like Redis or Memcached."
+            ),
+            id="products.W001",
+        )
+    ]
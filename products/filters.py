@@ -0,0 +1,104 @@
+from decimal import Decimal, InvalidOperation
+
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+from .cache import get_category_paths, get_facet_counts
+from .managers import PUBLISHED_STATUSES
+
+FILTER_PARAMS = [
+    "brand",
+    "manufacturer",
+    "category",
+    "status",
+    "min_price",
+    "max_price",
+]
+
+
+class ProductFilterBackend(BaseFilterBackend):
+    """
+    Filter products by brand, manufacturer, category subtree, status and
+    price range, which is matched against the effective price. ``brand``,
+    ``manufacturer`` and ``status`` may be repeated.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+
+        for field in ["brand", "manufacturer"]:
+            if params.getlist(field):
+                queryset = queryset.filter(**{f"{field}__in": params.getlist(field)})
+
+        if params.getlist("status"):
+            statuses = params.getlist("status")
+            if not set(statuses) <= set(PUBLISHED_STATUSES):
+                raise ValidationError(
+                    {"status": f"Choose from {', '.join(PUBLISHED_STATUSES)}"}
+                )
+            queryset = queryset.filter(status__in=statuses)
+
+        if "category" in params:
+            queryset = queryset.filter(
+                category_id__in=self.get_subtree(params["category"])
+            )
+
+        for param, lookup in [("min_price", "gte"), ("max_price", "lte")]:
+            if param in params:
+                price = self.get_price(param, params[param])
+                queryset = queryset.filter(**{f"effective_price__{lookup}": price})
+
+        return queryset
+
+    def is_filtered(self, request):
+        return any(param in request.query_params for param in FILTER_PARAMS)
+
+    def get_subtree(self, category):
+        try:
+            category = int(category)
+        except ValueError:
+            raise ValidationError({"category": "A valid integer is required."})
+
+        # descendants come from the breadcrumb map, without a tree query
+        return [
+            id
+            for id, path in get_category_paths().items()
+            if any(ancestor == category for ancestor, _ in path)
+        ]
+
+    def get_price(self, param, value):
+        try:
+            price = Decimal(value)
+        except InvalidOperation:
+            price = None
+        if price is None or not price.is_finite():
+            raise ValidationError({param: "A valid number is required."})
+        return price
+
+
+def get_facets(request, queryset):
+    """
+    Facet counts for ``queryset``. Unfiltered requests read the cached
+    catalog-wide counts instead of querying.
+    """
+    if ProductFilterBackend().is_filtered(request):
+        counts = queryset.facet_counts()
+    else:
+        counts = get_facet_counts()
+
+    # a product counts towards its category and every ancestor of it
+    categories = {}
+    paths = get_category_paths()
+    for category, count in counts["category"].items():
+        for ancestor, _ in paths.get(category, ()):
+            categories[ancestor] = categories.get(ancestor, 0) + count
+
+    return {
+        facet: [
+            {"value": value, "count": count}
+            for value, count in sorted(
+                values.items(), key=lambda item: (-item[1], str(item[0]))
+            )
+        ]
+        for facet, values in {**counts, "category": categories}.items()
+    }
@@ -0,0 +1,131 @@
+import threading
+from functools import lru_cache, partial
+
+from django.conf import settings
+from django.db import IntegrityError, connection, connections, transaction
+from django.utils.module_loading import import_string
+
+DEFAULT_ID_ALLOCATOR = "products.ids.BlockIDAllocator"
+
+
+class IDAllocator:
+    """
+    Hands out unique 10-digit product ids.
+    """
+
+    def allocate(self, count=1):
+        raise NotImplementedError
+
+
+class BlockIDAllocator(IDAllocator):
+    """
+    Leases blocks of ``block_size`` consecutive ids from an ``IDSequence``
+    row, one UPDATE per block, and hands them out from memory.
+
+    The sequence row is the only shared state, so processes and nodes on
+    the same database never get overlapping blocks. Ids already taken by
+    products, like the random ids from before the sequence, are skipped
+    with one query per block.
+
+    A block is leased in a short transaction of its own, on a separate
+    connection when the caller is inside a transaction, so the sequence
+    row is never locked for the length of the caller's transaction and a
+    rollback there loses nothing. SQLite only takes one writer at a time,
+    so a second connection could only wait for the caller; there the
+    lease joins the caller's transaction and the rest of the block is
+    pooled once it commits.
+    """
+
+    def __init__(self, name="product", block_size=1000):
+        self.name = name
+        self.block_size = block_size
+        self.start = 1_000_000_000
+        self.stop = 10_000_000_000
+        self.lock = threading.Lock()
+        self.block = []
+
+    def allocate(self, count=1):
+        # the lock only guards the pool, never a database round trip
+        with self.lock:
+            ids = self.block[:count]
+            del self.block[:count]
+        while len(ids) < count:
+            block, committed = self.lease()
+            taken = block[: count - len(ids)]
+            ids += taken
+            if committed:
+                self.release(block[len(taken) :])
+            else:
+                transaction.on_commit(partial(self.release, block[len(taken) :]))
+        return ids
+
+    def release(self, ids):
+        with self.lock:
+            self.block += ids
+
+    def lease(self):
+        """
+        Lease the next block, returning its free ids and whether the lease
+        is committed already.
+        """
+        from .models import Product
+
+        if connection.in_atomic_block and connection.vendor != "sqlite":
+            end = self.advance_on_new_connection()
+            committed = True
+        else:
+            committed = not connection.in_atomic_block
+            with transaction.atomic():
+                end = self.advance(connection)
+        if end > self.stop:
+            raise RuntimeError(f"{self.name} ids are exhausted")
+
+        block = [str(id) for id in range(end - self.block_size, end)]
+        taken = set(Product.objects.filter(id__in=block).values_list("id", flat=True))
+        return [id for id in block if id not in taken], committed
+
+    def advance_on_new_connection(self, retries=2):
+        lease_connection = connections.create_connection(connection.alias)
+        try:
+            lease_connection.set_autocommit(False)
+            for attempt in range(retries):
+                try:
+                    end = self.advance(lease_connection)
+                    lease_connection.commit()
+                    return end
+                except IntegrityError:
+                    # another process created the sequence row first
+                    lease_connection.rollback()
+                    if attempt == retries - 1:
+                        raise
+        finally:
+            lease_connection.close()
+
+    def advance(self, connection):
+        """
+        Move the sequence on by a block on ``connection``, creating it if
+        needed, and return its new next value.
+        """
+        from .models import IDSequence
+
+        table = connection.ops.quote_name(IDSequence._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET next_value = next_value + %s WHERE name = %s",
+                [self.block_size, self.name],
+            )
+            if not cursor.rowcount:
+                cursor.execute(
+                    f"INSERT INTO {table} (name, next_value) VALUES (%s, %s)",
+                    [self.name, self.start + self.block_size],
+                )
+            cursor.execute(
+                f"SELECT next_value FROM {table} WHERE name = %s", [self.name]
+            )
+            return cursor.fetchone()[0]
+
+
+@lru_cache(maxsize=None)
+def get_id_allocator():
+    path = getattr(settings, "PRODUCT_ID_ALLOCATOR", DEFAULT_ID_ALLOCATOR)
+    return import_string(path)()
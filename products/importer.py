@@ -0,0 +1,206 @@
+import csv
+import io
+import json
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import serializers
+
+from .ids import get_id_allocator
+from .models import Category, Product
+from .serializers import ProductCreateSerializer
+from .signals import products_bulk_changed
+from .utils import generate_titles_to_slugs
+
+FORMATS = ["csv", "ndjson"]
+
+
+class ProductImportSerializer(ProductCreateSerializer):
+    """
+    ``ProductCreateSerializer`` rules for one imported row, without its
+    per-row queries: categories are checked against ids loaded up front
+    and ids and slugs for uniqueness a batch at a time by ``import_products``.
+    """
+
+    category = serializers.IntegerField()
+
+    class Meta(ProductCreateSerializer.Meta):
+        extra_kwargs = {"id": {"validators": []}, "slug": {"validators": []}}
+
+    def validate_category(self, value):
+        if value not in self.context["category_ids"]:
+            raise serializers.ValidationError(
+                f'Invalid pk "{value}" - object does not exist.'
+            )
+        return value
+
+    def validate(self, attrs):
+        if attrs.get("id_type", "default") != "default" and not attrs.get("id"):
+            raise serializers.ValidationError(
+                {"id": f"This field is required for {attrs['id_type']} ids."}
+            )
+        return attrs
+
+
+def read_rows(file, format):
+    """
+    Rows of a CSV or NDJSON ``file`` opened in binary mode, read lazily.
+    Empty CSV cells are left out, as if the column was missing. Reading
+    stops at the first part of the file that isn't UTF-8 or valid CSV,
+    which is yielded as a ``ValidationError`` in place of the rest.
+    """
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        if format == "csv":
+            for row in csv.DictReader(text):
+                yield {
+                    key: value for key, value in row.items() if value not in ("", None)
+                }
+        elif format == "ndjson":
+            for line in text:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        yield None
+        else:
+            raise ValueError(f"Unknown format {format!r}, choose from {FORMATS}")
+    except UnicodeDecodeError:
+        yield serializers.ValidationError({"file": ["The file isn't UTF-8 encoded."]})
+    except csv.Error as error:
+        yield serializers.ValidationError({"file": [f"Invalid CSV: {error}."]})
+
+
+def import_products(owner, rows, chunk_size=5000):
+    """
+    Validate and create the products in ``rows`` for ``owner``, one
+    transaction and ``bulk_create`` per ``chunk_size`` rows. Invalid rows
+    are skipped and reported as ``{"row": number, "errors": {...}}``,
+    numbered from 1.
+
+    Signals are not sent per product; ``products_bulk_changed`` is sent
+    once per chunk instead.
+    """
+    serializer = ProductImportSerializer(
+        context={"category_ids": set(Category.objects.values_list("id", flat=True))}
+    )
+    rows = enumerate(rows, start=1)
+    created = 0
+    errors = []
+
+    while chunk := list(islice(rows, chunk_size)):
+        valid = []
+        for number, row in chunk:
+            if isinstance(row, serializers.ValidationError):
+                errors.append({"row": number, "errors": row.detail})
+                continue
+            if not isinstance(row, dict):
+                errors.append({"row": number, "errors": {"row": ["Invalid row."]}})
+                continue
+            try:
+                valid.append((number, serializer.run_validation(row)))
+            except serializers.ValidationError as error:
+                errors.append({"row": number, "errors": error.detail})
+
+        products, chunk_errors = write_products(owner, valid)
+        errors += chunk_errors
+        if products:
+            products_bulk_changed.send(sender=Product, products=products, created=True)
+        created += len(products)
+
+    errors.sort(key=lambda error: error["row"])
+    return created, errors
+
+
+def write_products(owner, valid, retries=3):
+    """
+    Create the products of validated rows in one transaction, allocating
+    ids and slugs again if a concurrent write took some of them first.
+    """
+    for attempt in range(retries):
+        numbers, products, errors = build_products(owner, valid)
+        try:
+            with transaction.atomic():
+                Product.objects.bulk_create(products)
+            return products, errors
+        except IntegrityError as error:
+            if attempt == retries - 1:
+                return [], errors + [
+                    {"row": number, "errors": {"row": [str(error)]}}
+                    for number in numbers
+                ]
+
+
+def build_products(owner, valid):
+    """
+    Unsaved products for validated ``(row number, data)`` pairs, with ids
+    and slugs allocated for the whole batch. Returns the row numbers and
+    products of accepted rows and the errors of rows whose id or slug is
+    taken.
+    """
+    errors = []
+    seen_ids = set()
+    seen_slugs = set()
+    taken_ids = set(
+        Product.objects.filter(
+            id__in=[data["id"] for _, data in valid if data.get("id")]
+        ).values_list("id", flat=True)
+    )
+    taken_slugs = set(
+        Product.objects.filter(
+            slug__in=[data["slug"] for _, data in valid if data.get("slug")]
+        ).values_list("slug", flat=True)
+    )
+
+    accepted = []
+    for number, data in valid:
+        row_errors = {}
+        if data.get("id") and (data["id"] in taken_ids or data["id"] in seen_ids):
+            row_errors["id"] = ["product with this Product ID already exists."]
+        if data.get("slug") and (
+            data["slug"] in taken_slugs or data["slug"] in seen_slugs
+        ):
+            row_errors["slug"] = ["product with this slug already exists."]
+        if row_errors:
+            errors.append({"row": number, "errors": row_errors})
+            continue
+        if data.get("id"):
+            seen_ids.add(data["id"])
+        if data.get("slug"):
+            seen_slugs.add(data["slug"])
+        accepted.append((number, data))
+
+    # explicit ids of the batch aren't in the database yet to be skipped
+    count = sum(1 for _, data in accepted if not data.get("id"))
+    ids = (
+        id
+        for id in get_id_allocator().allocate(count + len(seen_ids))
+        if id not in seen_ids
+    )
+    slugs = iter(
+        generate_titles_to_slugs(
+            Product,
+            [data["title"] for _, data in accepted if not data.get("slug")],
+            exclude=seen_slugs,
+        )
+    )
+
+    now = timezone.now()
+    products = []
+    for _, data in accepted:
+        product = Product(owner=owner, category_id=data["category"])
+        for field, value in data.items():
+            if field != "category":
+                setattr(product, field, value)
+        if not product.id:
+            product.id = str(next(ids))
+        if not product.slug:
+            product.slug = next(slugs)
+        # what save() and its signals would do for a single product
+        product.update_stock_status()
+        product.update_stock_alert()
+        if product.status == "published":
+            product.published_at = now
+        products.append(product)
+    return [number for number, _ in accepted], products, errors
@@ -0,0 +1,95 @@
+import itertools
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from accounts.models import User
+from products.models import Category, Product
+from products.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed products inside a rolled back transaction and time full-text "
+        "search queries against them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=1_000_000)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        vocabulary = self.make_vocabulary(rng, 5000)
+        backend = get_search_backend()
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            self.seed(rng, vocabulary, backend, options)
+            self.stdout.write(
+                f"seeded {options['products']} products "
+                f"in {time.perf_counter() - started:.1f}s"
+            )
+
+            timings = []
+            for _ in range(options["queries"]):
+                query = " ".join(rng.choices(vocabulary[:500], k=rng.randint(1, 2)))
+                started = time.perf_counter()
+                backend.search(query, 0, 20)
+                timings.append((time.perf_counter() - started) * 1000)
+
+            timings.sort()
+            self.stdout.write(
+                f"{len(timings)} queries: "
+                f"p50 {statistics.median(timings):.1f}ms, "
+                f"p95 {timings[int(len(timings) * 0.95)]:.1f}ms, "
+                f"max {timings[-1]:.1f}ms"
+            )
+            transaction.set_rollback(True)
+
+    def make_vocabulary(self, rng, size):
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        words = set()
+        while len(words) < size:
+            words.add("".join(rng.choices(letters, k=rng.randint(3, 9))))
+        return sorted(words)
+
+    def seed(self, rng, vocabulary, backend, options):
+        owner = User.objects.create(
+            username="benchmark", email="benchmark@example.com", role="seller"
+        )
+        category = Category.objects.create(title="benchmark")
+        # Zipf-like word frequencies, so a few words are very common
+        weights = list(
+            itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary)))
+        )
+        now = timezone.now()
+
+        for start in range(0, options["products"], options["batch_size"]):
+            stop = min(start + options["batch_size"], options["products"])
+            products = [
+                Product(
+                    id=str(1_000_000_000 + number),
+                    slug=f"benchmark-{number}",
+                    owner=owner,
+                    category=category,
+                    title=" ".join(rng.choices(vocabulary, cum_weights=weights, k=5)),
+                    brand=rng.choice(vocabulary[:100]),
+                    price=rng.randint(1, 1000),
+                    quantity=rng.randint(0, 100),
+                    description=" ".join(
+                        rng.choices(vocabulary, cum_weights=weights, k=20)
+                    ),
+                    status="published",
+                    published_at=now,
+                )
+                for number in range(start, stop)
+            ]
+            Product.objects.bulk_create(products)
+            backend.index(products)
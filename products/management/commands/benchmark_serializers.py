@@ -0,0 +1,99 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from accounts.models import User
+from products.models import Category, Product, ProductImage
+from products.serializers import ProductListSerializer, ProductSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed products inside a rolled back transaction and time rendering "
+        "product lists from model instances against .values() rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10_000])
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        request = Request(APIRequestFactory().get("/"))
+
+        with transaction.atomic():
+            self.seed(max(options["rows"]))
+            for rows in options["rows"]:
+                queryset = Product.objects.with_related().order_by("pk")[:rows]
+                for serializer_class in [ProductListSerializer, ProductSerializer]:
+                    self.compare(serializer_class, queryset, request, options)
+            transaction.set_rollback(True)
+
+    def compare(self, serializer_class, queryset, request, options):
+        context = {"request": request}
+
+        def instances():
+            return serializer_class(queryset, many=True, context=context).data
+
+        def values():
+            rows = serializer_class(many=True, context=context).values(queryset)
+            return serializer_class(rows, many=True, context=context).data
+
+        renderer = JSONRenderer()
+        if renderer.render(instances()) != renderer.render(values()):
+            raise CommandError(f"{serializer_class.__name__} output differs")
+
+        timings = {}
+        for name, render in [("instances", instances), ("values", values)]:
+            runs = []
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                render()
+                runs.append((time.perf_counter() - started) * 1000)
+            timings[name] = statistics.median(runs)
+
+        self.stdout.write(
+            f"{serializer_class.__name__}, {len(queryset)} rows: "
+            f"instances {timings['instances']:.1f}ms, "
+            f"values {timings['values']:.1f}ms "
+            f"({timings['instances'] / timings['values']:.1f}x)"
+        )
+
+    def seed(self, count):
+        owner = User.objects.create(
+            username="benchmark", email="benchmark@example.com", role="seller"
+        )
+        category = Category.objects.create(title="benchmark")
+        child = Category.objects.create(title="child", parent=category)
+        now = timezone.now()
+
+        products = Product.objects.bulk_create(
+            Product(
+                id=str(1_000_000_000 + number),
+                slug=f"benchmark-{number}",
+                owner=owner,
+                category=child,
+                title=f"benchmark product {number}",
+                brand="brand",
+                price=number % 1000 + 0.99,
+                discount_price=number % 1000 if number % 2 else None,
+                quantity=number % 100,
+                description="<p>benchmark description</p>",
+                status="published",
+                published_at=now,
+            )
+            for number in range(count)
+        )
+        ProductImage.objects.bulk_create(
+            ProductImage(
+                product=product,
+                thumbnail=f"thumbnails/{product.pk}.png",
+                image_1=f"images/{product.pk}-1.png",
+            )
+            for product in products
+        )
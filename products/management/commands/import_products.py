@@ -0,0 +1,41 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.models import User
+from products.importer import FORMATS, import_products, read_rows
+
+
+class Command(BaseCommand):
+    help = "Import products for a seller from a CSV or NDJSON file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--owner", required=True, help="Seller email")
+        parser.add_argument("--format", choices=FORMATS)
+        parser.add_argument("--chunk-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        try:
+            owner = User.objects.get(email=options["owner"], role="seller")
+        except User.DoesNotExist:
+            raise CommandError(f"No seller with email {options['owner']}")
+
+        path = options["path"]
+        format = options["format"] or path.rsplit(".", 1)[-1].lower()
+        if format not in FORMATS:
+            raise CommandError(f"Unknown format {format}, pass --format")
+
+        started = time.perf_counter()
+        with open(path, "rb") as file:
+            created, errors = import_products(
+                owner, read_rows(file, format), options["chunk_size"]
+            )
+
+        for error in errors:
+            self.stderr.write(f"row {error['row']}: {json.dumps(error['errors'])}")
+        self.stdout.write(
+            f"created {created} products, {len(errors)} rows rejected "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from products.profiles import reconcile_buyers, reconcile_sellers
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the order totals of buyer and seller profiles from the "
+        "orders, report the ones that drifted and fix them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Report drift without fixing it."
+        )
+
+    def handle(self, *args, **options):
+        fix = not options["dry_run"]
+        for name, reconcile in [
+            ("buyer", reconcile_buyers),
+            ("seller", reconcile_sellers),
+        ]:
+            drifted = 0
+            for user_id, field, stored, expected in reconcile(
+                options["batch_size"], fix
+            ):
+                drifted += 1
+                self.stdout.write(
+                    f"{name} {user_id} {field}: stored {stored}, expected {expected}"
+                )
+            action = "fixed" if fix else "found"
+            self.stdout.write(f"{drifted} drifted {name} totals {action}")
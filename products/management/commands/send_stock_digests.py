@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from products.utils import send_stock_digests
+
+
+class Command(BaseCommand):
+    help = (
+        "Queue one stock alert email per seller for the products that ran "
+        "out of stock or low since the last run. Run it every "
+        "STOCK_DIGEST_WINDOW seconds, e.g. from cron, when Celery beat is "
+        "not used."
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Queued {send_stock_digests()} stock digests")
@@ -1,11 +1,247 @@
-from django.db import models
-from django.db.models import Q
+from django.conf import settings
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import (
+    BooleanField,
+    Case,
+    Count,
+    DecimalField,
+    F,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
+PUBLISHED_STATUSES = ["published", "out_of_stack"]
 
-class PublishedProductManager(models.Manager):
+# facet name -> Product attribute it counts
+FACET_FIELDS = {
+    "brand": "brand",
+    "manufacturer": "manufacturer",
+    "category": "category_id",
+    "status": "status",
+}
+
+# Product fields derived from the price fields by Product.set_effective_price()
+PRICE_FIELDS = ["price", "discount_price"]
+EFFECTIVE_PRICE_FIELDS = ["effective_price", "discount_percent"]
+
+# Product fields remembered as loaded, for signal handlers to tell what a
+# save changed; large ones like description are left out
+TRACKED_FIELDS = ["slug", "title", *FACET_FIELDS.values(), *PRICE_FIELDS]
+
+
+class ProductQuerySet(models.QuerySet):
+    def with_related(self):
+        """
+        Join everything ``ProductSerializer`` renders, so serializing a
+        product list costs one query whatever its length.
+        """
+        return self.select_related("images")
+
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create() skips save(), which maintains the effective price
+        objs = list(objs)
+        for obj in objs:
+            obj.set_effective_price()
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        fields = list(fields)
+        if set(fields) & set(PRICE_FIELDS):
+            objs = list(objs)
+            for obj in objs:
+                obj.set_effective_price()
+            fields += [field for field in EFFECTIVE_PRICE_FIELDS if field not in fields]
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def mark_out_of_stock(self):
+        """
+        Move published products without stock to out of stack with one
+        UPDATE, returning ``pk``, ``slug`` and ``title`` of the products moved.
+        The UPDATE checks the stock again, so a product restocked since it
+        was read stays published.
+        """
+        out_of_stock = self.filter(status="published", quantity=0)
+        products = list(out_of_stock.values("pk", "slug", "title"))
+        out_of_stock.filter(pk__in=[product["pk"] for product in products]).update(
+            status="out_of_stack", published_at=None
+        )
+        return products
+
+    def mark_in_stock(self):
+        """
+        Publish out of stack products that have stock again, with one UPDATE.
+        """
+        return self.filter(status="out_of_stack", quantity__gt=0).update(
+            status="published", published_at=timezone.now()
+        )
+
+    def flag_stock_alerts(self):
+        """
+        Flag published products out of stock or at most
+        ``LOW_STOCK_THRESHOLD`` left for the next stock digest, with one
+        UPDATE.
+        """
+        return self.filter(
+            status__in=PUBLISHED_STATUSES,
+            quantity__lte=settings.LOW_STOCK_THRESHOLD,
+            stock_alert_at__isnull=True,
+        ).update(stock_alert_at=timezone.now())
+
+    def facet_counts(self):
+        """
+        Count products per value of every facet, one grouped query each.
+        """
+        counts = {}
+        for facet, field in FACET_FIELDS.items():
+            rows = self.order_by().values_list(field).annotate(count=Count("pk"))
+            counts[facet] = {value: count for value, count in rows if value}
+        return counts
+
+
+class PublishedProductManager(models.Manager.from_queryset(ProductQuerySet)):
     def get_queryset(self):
-        return (
-            super()
-            .get_queryset()
-            .filter(Q(status="published") | Q(status="out_of_stack"))
+        # the same condition as the partial product_catalog_idx
+        return super().get_queryset().filter(status__in=PUBLISHED_STATUSES)
+
+
+class CartQuerySet(models.QuerySet):
+    def with_totals(self):
+        """
+        Annotate each line with its ``line_total`` at the effective price
+        and whether it is ``available``: published with enough stock.
+        """
+        return self.annotate(
+            line_total=F("product__effective_price") * F("quantity"),
+            available=Case(
+                When(
+                    product__status="published",
+                    product__quantity__gte=F("quantity"),
+                    then=Value(True),
+                ),
+                default=Value(False),
+                output_field=BooleanField(),
+            ),
+        )
+
+    def totals(self):
+        """
+        Item count, subtotal at list price, discount and total of the
+        lines, with one aggregate query.
+        """
+        money = DecimalField(max_digits=14, decimal_places=2)
+        totals = self.aggregate(
+            items=Coalesce(Sum("quantity"), 0),
+            subtotal=Coalesce(
+                Sum(F("product__price") * F("quantity"), output_field=money),
+                Value(0),
+                output_field=money,
+            ),
+            total=Coalesce(
+                Sum(F("product__effective_price") * F("quantity"), output_field=money),
+                Value(0),
+                output_field=money,
+            ),
+        )
+        totals["discount"] = totals["subtotal"] - totals["total"]
+        return totals
+
+    def apply(self, user, operations, product_ids):
+        """
+        Apply ``(op, product id, quantity)`` operations to ``user``'s cart
+        with one read of the affected lines and a bulk create, update and
+        delete. Operations on one product apply in order; a line set to 0
+        is removed.
+        """
+        lines = {
+            line.product_id: line
+            for line in self.filter(
+                user=user, product_id__in=product_ids
+            ).select_for_update()
+        }
+        quantities = {id: line.quantity for id, line in lines.items()}
+        for op, product_id, quantity in operations:
+            if op == "add":
+                quantities[product_id] = quantities.get(product_id, 0) + quantity
+            elif op == "set":
+                quantities[product_id] = quantity
+            else:
+                quantities[product_id] = 0
+
+        created, updated, removed = [], [], []
+        for product_id, quantity in quantities.items():
+            line = lines.get(product_id)
+            if line is None:
+                if quantity:
+                    created.append(
+                        self.model(user=user, product_id=product_id, quantity=quantity)
+                    )
+            elif not quantity:
+                removed.append(line.pk)
+            elif quantity != line.quantity:
+                line.quantity = quantity
+                updated.append(line)
+
+        self.bulk_create(created)
+        self.bulk_update(updated, ["quantity"])
+        self.filter(pk__in=removed).delete()
+
+    def add(self, user, slug, quantity):
+        """
+        Add ``quantity`` of the product with ``slug`` to ``user``'s cart,
+        on top of any quantity already there. Returns the cart line as
+        ``(id, product_id, quantity)``, or None when there is no such
+        product.
+
+        Databases with ON CONFLICT ... RETURNING, PostgreSQL and SQLite
+        3.35 or later, do it in a single statement, so concurrent adds of
+        one product never lose an update.
+        """
+        features = connections[self.db].features
+        if (
+            features.supports_update_conflicts_with_target
+            and features.can_return_rows_from_bulk_insert
+        ):
+            return self.upsert(user, slug, quantity)
+        return self.add_with_update(user, slug, quantity)
+
+    def upsert(self, user, slug, quantity):
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        cart = quote(self.model._meta.db_table)
+        product = quote(
+            self.model._meta.get_field("product").related_model._meta.db_table
         )
+        sql = (
+            f"INSERT INTO {cart} (user_id, product_id, quantity) "
+            f"SELECT %s, id, %s FROM {product} WHERE slug = %s "
+            "ON CONFLICT (user_id, product_id) DO UPDATE "
+            f"SET quantity = {cart}.quantity + excluded.quantity "
+            "RETURNING id, product_id, quantity"
+        )
+        with connection.cursor() as cursor:
+            user_id = self.model._meta.get_field("user").get_db_prep_value(
+                user.pk, connection
+            )
+            cursor.execute(sql, [user_id, quantity, slug])
+            return cursor.fetchone()
+
+    def add_with_update(self, user, slug, quantity):
+        Product = self.model._meta.get_field("product").related_model
+        product_id = Product.objects.filter(slug=slug).values_list("pk", flat=True)
+        product_id = product_id.first()
+        if product_id is None:
+            return None
+
+        line = self.filter(user=user, product_id=product_id)
+        with transaction.atomic(using=self.db):
+            if not line.update(quantity=F("quantity") + quantity):
+                try:
+                    with transaction.atomic(using=self.db):
+                        self.create(user=user, product_id=product_id, quantity=quantity)
+                except IntegrityError:
+                    # a concurrent add created the line first
+                    line.update(quantity=F("quantity") + quantity)
+            return line.values_list("id", "product_id", "quantity").get()
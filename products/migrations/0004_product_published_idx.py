@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-18 18:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("products", "0003_remove_product_thumbnail_productimage_thumbnail_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                fields=["published_at", "id"], name="product_published_idx"
+            ),
+        ),
+    ]
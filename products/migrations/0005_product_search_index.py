@@ -0,0 +1,88 @@
+import hashlib
+
+from django.db import migrations
+from django.utils.html import strip_tags
+
+FTS_TABLE = "products_product_fts"
+
+# the same expression as PostgreSQLSearchBackend.document, so its queries
+# can use the index
+POSTGRESQL_DOCUMENT = " || ".join(
+    f"setweight(to_tsvector('english', coalesce({field}, '')), '{weight}')"
+    for field, weight in [
+        ("title", "A"),
+        ("brand", "B"),
+        ("manufacturer", "B"),
+        ("description", "D"),
+    ]
+)
+
+
+def rowid(pk):
+    # the same key as SQLiteSearchBackend.rowid
+    digest = hashlib.blake2b(str(pk).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == "postgresql":
+        # maintained by PostgreSQL itself, so there is nothing to backfill
+        schema_editor.execute(
+            "CREATE INDEX product_search_idx ON products_product "
+            f"USING GIN (({POSTGRESQL_DOCUMENT}))"
+        )
+    elif connection.vendor == "sqlite":
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            "product_id UNINDEXED, title, brand, manufacturer, description)"
+        )
+        Product = apps.get_model("products", "Product")
+        rows = (
+            Product._base_manager.using(connection.alias)
+            .values_list("pk", "title", "brand", "manufacturer", "description")
+            .iterator(chunk_size=1000)
+        )
+        batch = []
+        for pk, title, brand, manufacturer, description in rows:
+            batch.append(
+                (
+                    rowid(pk),
+                    str(pk),
+                    title,
+                    brand,
+                    manufacturer,
+                    strip_tags(description),
+                )
+            )
+            if len(batch) == 1000:
+                insert_rows(connection, batch)
+                batch = []
+        insert_rows(connection, batch)
+
+
+def insert_rows(connection, rows):
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT OR REPLACE INTO {FTS_TABLE} "
+            "(rowid, product_id, title, brand, manufacturer, description) "
+            "VALUES (%s, %s, %s, %s, %s, %s)",
+            rows,
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS product_search_idx")
+    elif schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("products", "0004_product_published_idx"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
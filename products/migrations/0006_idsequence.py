@@ -0,0 +1,28 @@
+# Generated by Django 4.2.2 on 2026-10-18 19:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("products", "0005_product_search_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IDSequence",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=50, unique=True)),
+                ("next_value", models.BigIntegerField()),
+            ],
+        ),
+    ]
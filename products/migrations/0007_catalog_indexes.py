@@ -0,0 +1,38 @@
+# Generated by Django 4.2.2 on 2026-10-18 19:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("products", "0006_idsequence"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                fields=["status", "published_at"], name="product_status_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                fields=["owner", "created_at"], name="product_owner_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                fields=["category", "status"], name="product_category_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                condition=models.Q(("status__in", ["published", "out_of_stack"])),
+                fields=["published_at", "id"],
+                name="product_catalog_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.2 on 2026-10-18 19:38
+
+from django.db import migrations, models
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Cast, Coalesce, Round
+
+
+def set_effective_price(apps, schema_editor):
+    # one UPDATE for the whole table, same rules as Product.set_effective_price
+    Product = apps.get_model("products", "Product")
+    Product._base_manager.update(
+        effective_price=Coalesce("discount_price", "price"),
+        discount_percent=Case(
+            When(
+                price__gt=0,
+                discount_price__gte=0,
+                discount_price__lt=F("price"),
+                then=Cast(
+                    Round((F("price") - F("discount_price")) * 100 / F("price")),
+                    models.IntegerField(),
+                ),
+            ),
+            default=Value(0),
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("products", "0007_catalog_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="product",
+            name="discount_percent",
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="effective_price",
+            field=models.DecimalField(
+                decimal_places=2, default=0, editable=False, max_digits=12
+            ),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_effective_price, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                fields=["effective_price", "id"], name="product_price_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                fields=["category", "effective_price"],
+                name="product_category_price_idx",
+            ),
+        ),
+    ]
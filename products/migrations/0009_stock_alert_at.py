@@ -0,0 +1,23 @@
+# Generated by Django 4.2.2 on 2026-10-18 19:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("products", "0008_effective_price"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="product",
+            name="stock_alert_at",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                fields=["stock_alert_at"], name="product_stock_alert_idx"
+            ),
+        ),
+    ]
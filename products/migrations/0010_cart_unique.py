@@ -0,0 +1,35 @@
+# Generated by Django 4.2.2 on 2026-10-18 19:48
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    # one line per user and product, holding the quantities of all of them
+    Cart = apps.get_model("products", "Cart")
+    duplicates = (
+        Cart._base_manager.values("user", "product")
+        .annotate(count=Count("id"), first=Min("id"), quantity=Sum("quantity"))
+        .filter(count__gt=1)
+    )
+    for line in duplicates:
+        Cart._base_manager.filter(pk=line["first"]).update(quantity=line["quantity"])
+        Cart._base_manager.filter(user=line["user"], product=line["product"]).exclude(
+            pk=line["first"]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("products", "0009_stock_alert_at"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="cart",
+            constraint=models.UniqueConstraint(
+                fields=("user", "product"), name="cart_user_product_unique"
+            ),
+        ),
+    ]
@@ -1,11 +1,24 @@
+from decimal import ROUND_HALF_UP, Decimal
+
 from ckeditor.fields import RichTextField
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 from mptt.models import MPTTModel, TreeForeignKey, TreeManager
 
 from accounts.models import User
 
-from .managers import PublishedProductManager
+from .ids import get_id_allocator
+from .managers import (
+    EFFECTIVE_PRICE_FIELDS,
+    PRICE_FIELDS,
+    PUBLISHED_STATUSES,
+    TRACKED_FIELDS,
+    CartQuerySet,
+    ProductQuerySet,
+    PublishedProductManager,
+)
 from .utils import *
 
 
@@ -14,6 +27,32 @@ class CategoryManager(TreeManager):
         queryset = self.get_queryset().filter(level=0)
         return queryset
 
+    def tree(self):
+        """
+        Build the whole category tree from a single query in tree order.
+        """
+        nodes = {}
+        roots = []
+        categories = self.get_queryset().values_list("id", "title", "parent_id")
+        for id, title, parent_id in categories:
+            node = {"id": id, "title": title, "sub_category": []}
+            nodes[id] = node
+            if parent_id is None:
+                roots.append(node)
+            else:
+                nodes[parent_id]["sub_category"].append(node)
+        return roots
+
+    def paths(self):
+        """
+        Map every category id to its ``(id, title)`` ancestor path, root first.
+        """
+        paths = {}
+        categories = self.get_queryset().values_list("id", "title", "parent_id")
+        for id, title, parent_id in categories:
+            paths[id] = paths.get(parent_id, ()) + ((id, title),)
+        return paths
+
 
 class Category(MPTTModel):
     title = models.CharField(max_length=50)
@@ -69,33 +108,167 @@ class Product(models.Model):
     discount_price = models.DecimalField(
         max_digits=12, decimal_places=2, blank=True, null=True
     )
+    # discount_price when set, else price; see set_effective_price()
+    effective_price = models.DecimalField(
+        max_digits=12, decimal_places=2, editable=False
+    )
+    discount_percent = models.PositiveSmallIntegerField(default=0, editable=False)
     quantity = models.PositiveIntegerField()
     description = RichTextField()
     status = models.CharField(max_length=20, choices=PRODUCT_STATUS, default="draft")
     created_at = models.DateTimeField(auto_now_add=True)
     published_at = models.DateTimeField(blank=True, null=True)
+    # pending for the owner's next stock digest since, see STOCK_DIGEST
+    stock_alert_at = models.DateTimeField(blank=True, null=True, editable=False)
 
     published_objects = PublishedProductManager()
-    objects = models.Manager()
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # keyset pagination of the catalog, see KeysetPagination; the
+            # partial copy over published products only is used by
+            # PostgreSQL, SQLite can't match it against bound parameters
+            models.Index(fields=["published_at", "id"], name="product_published_idx"),
+            models.Index(
+                fields=["published_at", "id"],
+                condition=models.Q(status__in=PUBLISHED_STATUSES),
+                name="product_catalog_idx",
+            ),
+            models.Index(fields=["status", "published_at"], name="product_status_idx"),
+            # seller product lists
+            models.Index(fields=["owner", "created_at"], name="product_owner_idx"),
+            # category filters of the catalog
+            models.Index(fields=["category", "status"], name="product_category_idx"),
+            # ?ordering=effective_price and price range filters
+            models.Index(fields=["effective_price", "id"], name="product_price_idx"),
+            models.Index(
+                fields=["category", "effective_price"],
+                name="product_category_price_idx",
+            ),
+            # products pending for the stock digests
+            models.Index(fields=["stock_alert_at"], name="product_stock_alert_idx"),
+        ]
 
     def __str__(self):
         return str(self.id)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # values as loaded, so signal handlers can tell what a save changed
+        instance._loaded_values = {
+            field: value
+            for field, value in zip(field_names, values)
+            if field in TRACKED_FIELDS
+        }
+        return instance
+
     def clean(self):
         if self.owner.role != "seller":
             raise ValidationError({"owner": "User role must be Seller"})
 
+    def set_effective_price(self):
+        """
+        Denormalize the price a buyer pays and its discount off ``price``
+        in whole percent, so the catalog sorts and filters by price on an
+        indexed column.
+        """
+        price = self._meta.get_field("price").to_python(self.price)
+        discount_price = self._meta.get_field("discount_price").to_python(
+            self.discount_price
+        )
+        self.effective_price = price if discount_price is None else discount_price
+        self.discount_percent = 0
+        if price > 0 and 0 <= self.effective_price < price:
+            percent = (price - self.effective_price) * 100 / price
+            self.discount_percent = int(percent.quantize(Decimal(1), ROUND_HALF_UP))
+
+    def update_stock_status(self):
+        """
+        Move a published product without stock to out of stack, and an out
+        of stack one with stock back to published, as part of the write
+        that changes its stock. Returns whether it ran out of stock.
+        """
+        if self.status == "published" and self.quantity == 0:
+            self.status = "out_of_stack"
+            self.published_at = None
+            return True
+        if self.status == "out_of_stack" and self.quantity > 0:
+            # published_at is set again by the update_published_time signal
+            self.status = "published"
+        return False
+
+    def update_stock_alert(self):
+        """
+        Flag the product for the owner's next stock digest when it is out
+        of stock or at most ``LOW_STOCK_THRESHOLD`` left.
+        """
+        if (
+            settings.STOCK_DIGEST
+            and self.stock_alert_at is None
+            and self.status in PUBLISHED_STATUSES
+            and self.quantity <= settings.LOW_STOCK_THRESHOLD
+        ):
+            self.stock_alert_at = timezone.now()
+
     def save(self, *args, **kwargs):
         if self.owner.role != "seller":
             return ValueError("User role must be seller")
 
-        if not self.id and self.id_type == "default":
-            self.id = generate_random_number(Product)
+        self.set_effective_price()
+        self._stocked_out = self.update_stock_status()
+        self.update_stock_alert()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if update_fields & set(PRICE_FIELDS):
+                update_fields |= set(EFFECTIVE_PRICE_FIELDS)
+            if update_fields & {"quantity", "status"}:
+                update_fields |= {"status", "published_at", "stock_alert_at"}
+            kwargs["update_fields"] = update_fields
 
-        if not self.slug:
+        if not self.id and self.id_type == "default":
+            self.id = get_id_allocator().allocate()[0]
+
+        # post_save handlers, like the out of stock email, commit with the row
+        with transaction.atomic():
+            if self.slug:
+                super(Product, self).save(*args, **kwargs)
+            else:
+                self.save_with_new_slug(*args, **kwargs)
+        deferred = self.get_deferred_fields()
+        self._loaded_values = {
+            field: getattr(self, field)
+            for field in TRACKED_FIELDS
+            if field not in deferred
+        }
+
+    def save_with_new_slug(self, *args, retries=3, **kwargs):
+        # a concurrent save can take the slug between picking and inserting it
+        for attempt in range(retries):
             self.slug = generate_title_to_slug(Product, self.title)
+            try:
+                with transaction.atomic():
+                    super(Product, self).save(*args, **kwargs)
+                return
+            except IntegrityError:
+                slug_taken = Product.objects.filter(slug=self.slug).exists()
+                if not slug_taken or attempt == retries - 1:
+                    raise
+
 
-        super(Product, self).save(*args, **kwargs)
+class IDSequence(models.Model):
+    """
+    Next free value of a named id sequence, leased out in blocks by
+    ``products.ids.BlockIDAllocator``.
+    """
+
+    name = models.CharField(max_length=50, unique=True)
+    next_value = models.BigIntegerField()
+
+    def __str__(self):
+        return self.name
 
 
 class ProductImage(models.Model):
@@ -148,5 +321,60 @@ class Cart(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField()
 
+    objects = CartQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # the conflict target of CartQuerySet.upsert()
+            models.UniqueConstraint(
+                fields=["user", "product"], name="cart_user_product_unique"
+            ),
+        ]
+
     def __str__(self):
         return self.user.email
+
+
+ORDER_STATUS = (
+    ("placed", "Placed"),
+    ("refunded", "Refunded"),
+)
+
+
+class Order(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="orders")
+    status = models.CharField(max_length=20, choices=ORDER_STATUS, default="placed")
+    subtotal = models.DecimalField(max_digits=14, decimal_places=2)
+    discount = models.DecimalField(max_digits=14, decimal_places=2)
+    total = models.DecimalField(max_digits=14, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "created_at"], name="order_user_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.pk} {self.user.email}"
+
+
+class OrderItem(models.Model):
+    """
+    A product bought with an order, with its title, seller and prices as
+    they were at checkout.
+    """
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="items")
+    product = models.ForeignKey(
+        Product, on_delete=models.SET_NULL, blank=True, null=True
+    )
+    seller = models.ForeignKey(
+        User, on_delete=models.SET_NULL, blank=True, null=True, related_name="sales"
+    )
+    title = models.CharField(max_length=500)
+    price = models.DecimalField(max_digits=12, decimal_places=2)
+    unit_price = models.DecimalField(max_digits=12, decimal_places=2)
+    quantity = models.PositiveIntegerField()
+
+    def __str__(self):
+        return self.title
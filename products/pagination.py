@@ -0,0 +1,147 @@
+import base64
+import json
+from functools import reduce
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (seek) pagination with opaque cursors.
+
+    Every page is an indexed range scan on the view's ``ordering`` that
+    starts right after the last row of the previous page, so no OFFSET or
+    COUNT(*) is issued and rows inserted meanwhile never shift the pages.
+    The last ordering field must be unique. Only the first one may be
+    nullable; NULLs are served after every other row.
+
+    Pagination is opt-in: it only applies when ``cursor`` or ``page_size``
+    is present in the query string.
+    """
+
+    ordering = ("-published_at", "-id")
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    page_size = 20
+    max_page_size = 100
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if self.page_size is None:
+            return None
+
+        self.request = request
+        self.model = queryset.model
+        self.ordering = self.get_ordering(view)
+        position = self.decode_cursor(request)
+
+        first_field = self.ordering[0].lstrip("-")
+        limit = self.page_size + 1
+        page = []
+
+        if position is None or position[0] is not None:
+            values = queryset.filter(**{f"{first_field}__isnull": False})
+            page = list(self.seek(values, self.ordering, position)[:limit])
+
+        if len(page) < limit and self.model._meta.get_field(first_field).null:
+            nulls = queryset.filter(**{f"{first_field}__isnull": True})
+            if position is not None and position[0] is None:
+                position = position[1:]
+            else:
+                position = None
+            page += list(self.seek(nulls, self.ordering[1:], position)[:limit])
+
+        self.has_next = len(page) > self.page_size
+        self.page = page[: self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True},
+                "results": schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        params = request.query_params
+        if (
+            self.page_size_query_param not in params
+            and self.cursor_query_param not in params
+        ):
+            return None
+
+        try:
+            page_size = int(params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, view):
+        return tuple(getattr(view, "ordering", None) or self.ordering)
+
+    def seek(self, queryset, ordering, position):
+        queryset = queryset.order_by(*ordering)
+        if position is None:
+            return queryset
+
+        # (a, b) after (x, y)  <=>  a after x OR (a = x AND b after y)
+        conditions = []
+        for index, field in enumerate(ordering):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            equal = {
+                other.lstrip("-"): value
+                for other, value in zip(ordering[:index], position)
+            }
+            conditions.append(Q(**equal, **{f"{name}__{lookup}": position[index]}))
+        return queryset.filter(reduce(lambda a, b: a | b, conditions))
+
+    def get_position(self, item):
+        if isinstance(item, dict):
+            return [item[field.lstrip("-")] for field in self.ordering]
+        return [getattr(item, field.lstrip("-")) for field in self.ordering]
+
+    def encode_cursor(self, position):
+        # str() keeps full datetime precision, unlike DjangoJSONEncoder
+        data = json.dumps(position, default=str).encode()
+        return base64.urlsafe_b64encode(data).decode()
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if len(position) != len(self.ordering):
+                raise ValueError
+            return [
+                None if value is None else self.get_field(field).to_python(value)
+                for field, value in zip(self.ordering, position)
+            ]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_field(self, field):
+        return self.model._meta.get_field(field.lstrip("-"))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        cursor = self.encode_cursor(self.get_position(self.page[-1]))
+        url = replace_query_param(url, self.cursor_query_param, cursor)
+        return replace_query_param(url, self.page_size_query_param, self.page_size)
@@ -0,0 +1,141 @@
+from decimal import Decimal
+
+from django.db.models import Count, DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from accounts.models import BuyerProfile, SellerProfie
+
+from .models import Order, OrderItem
+
+# Order totals kept on the profiles, so reading them is O(1):
+#   BuyerProfile.total_order     placed orders, refunded ones not counted
+#   BuyerProfile.total_purchase  total of placed orders
+#   SellerProfie.revenue         sales of every order, refunded or not
+#   SellerProfie.income          sales of placed orders, net of refunds
+
+MONEY = DecimalField(max_digits=12, decimal_places=2)
+ZERO = Value(Decimal(0), output_field=MONEY)
+
+
+def add(field, amount):
+    return Coalesce(F(field), ZERO, output_field=MONEY) + Value(amount, MONEY)
+
+
+def update_profile_totals(user_id, total, sales, refund=False):
+    """
+    Add an order of ``user_id`` for ``total``, and its ``sales`` as
+    ``{seller id: amount}``, to the profile totals with ``F()`` updates,
+    or take them off again for a ``refund``. Sellers are updated in id
+    order, so concurrent orders can't deadlock on their rows.
+    """
+    sign = -1 if refund else 1
+    BuyerProfile.objects.filter(user_id=user_id).update(
+        total_order=F("total_order") + sign,
+        total_purchase=add("total_purchase", sign * total),
+    )
+    for seller_id, amount in sorted(sales.items()):
+        totals = {"income": add("income", sign * amount)}
+        if not refund:
+            totals["revenue"] = add("revenue", amount)
+        SellerProfie.objects.filter(user_id=seller_id).update(**totals)
+
+
+def get_sales(order):
+    """
+    ``{seller id: amount}`` of ``order``, with one grouped query.
+    """
+    sales = (
+        order.items.filter(seller__isnull=False)
+        .values("seller")
+        .annotate(amount=Sum(F("unit_price") * F("quantity"), output_field=MONEY))
+        .order_by()
+    )
+    return {sale["seller"]: sale["amount"] for sale in sales}
+
+
+def get_buyer_totals():
+    """
+    Subquery expressions recomputing the ``BuyerProfile`` totals.
+    """
+    orders = (
+        Order.objects.filter(user=OuterRef("user"), status="placed")
+        .order_by()
+        .values("user")
+    )
+    return {
+        "total_order": Coalesce(
+            Subquery(orders.annotate(value=Count("pk")).values("value")), 0
+        ),
+        "total_purchase": Coalesce(
+            Subquery(orders.annotate(value=Sum("total")).values("value")),
+            ZERO,
+            output_field=MONEY,
+        ),
+    }
+
+
+def get_seller_totals():
+    """
+    Subquery expressions recomputing the ``SellerProfie`` totals.
+    """
+    items = (
+        OrderItem.objects.filter(seller=OuterRef("user")).order_by().values("seller")
+    )
+    amount = Sum(F("unit_price") * F("quantity"), output_field=MONEY)
+    return {
+        "revenue": Coalesce(
+            Subquery(items.annotate(value=amount).values("value")),
+            ZERO,
+            output_field=MONEY,
+        ),
+        "income": Coalesce(
+            Subquery(
+                items.filter(order__status="placed")
+                .annotate(value=amount)
+                .values("value")
+            ),
+            ZERO,
+            output_field=MONEY,
+        ),
+    }
+
+
+def reconcile(queryset, totals, batch_size=1000, fix=True):
+    """
+    Compare the stored ``totals`` of ``queryset``'s profiles with what the
+    orders add up to, a batch of profiles per query, and with ``fix``
+    overwrite the drifted ones with one set-based UPDATE per batch.
+    Yields ``(user id, field, stored, expected)`` for every drift.
+    """
+    expected = {f"expected_{field}": total for field, total in totals.items()}
+    last = None
+    while True:
+        batch = queryset.order_by("pk")
+        if last is not None:
+            batch = batch.filter(pk__gt=last)
+        rows = list(
+            batch.annotate(**expected).values("pk", "user_id", *totals, *expected)[
+                :batch_size
+            ]
+        )
+        if not rows:
+            return
+        last = rows[-1]["pk"]
+
+        drifted = []
+        for row in rows:
+            for field in totals:
+                stored, value = row[field] or 0, row[f"expected_{field}"]
+                if stored != value:
+                    drifted.append(row["pk"])
+                    yield row["user_id"], field, stored, value
+        if fix and drifted:
+            queryset.filter(pk__in=drifted).update(**totals)
+
+
+def reconcile_buyers(batch_size=1000, fix=True):
+    return reconcile(BuyerProfile.objects.all(), get_buyer_totals(), batch_size, fix)
+
+
+def reconcile_sellers(batch_size=1000, fix=True):
+    return reconcile(SellerProfie.objects.all(), get_seller_totals(), batch_size, fix)
@@ -0,0 +1,216 @@
+import hashlib
+import re
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils.html import strip_tags
+
+from .managers import PUBLISHED_STATUSES
+
+FTS_TABLE = "products_product_fts"
+SEARCH_FIELDS = ["title", "brand", "manufacturer", "description"]
+
+
+def tokenize(query):
+    return re.findall(r"\w+", query.lower())
+
+
+class SearchBackend:
+    """
+    Full-text index over ``Product`` text fields.
+
+    ``search`` returns ids of published products, best match first.
+    """
+
+    def create_index(self, schema_editor):
+        pass
+
+    def drop_index(self, schema_editor):
+        pass
+
+    def index(self, products):
+        pass
+
+    def remove(self, pks):
+        pass
+
+    def search(self, query, offset, limit):
+        raise NotImplementedError
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    FTS5 table holding a copy of the searchable text, ranked with bm25.
+
+    Rows are keyed on a 64-bit hash of the product id so they can be
+    replaced or removed through the rowid index, even once the product
+    row itself is gone.
+    """
+
+    # bm25 weight per column: product_id, title, brand, manufacturer, description
+    weights = (0.0, 10.0, 4.0, 4.0, 1.0)
+
+    @staticmethod
+    def rowid(pk):
+        digest = hashlib.blake2b(str(pk).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big", signed=True)
+
+    def create_index(self, schema_editor):
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            "product_id UNINDEXED, title, brand, manufacturer, description)"
+        )
+
+    def drop_index(self, schema_editor):
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+    def index(self, products):
+        # one transaction, rather than a commit per row in autocommit mode
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO {FTS_TABLE} "
+                "(rowid, product_id, title, brand, manufacturer, description) "
+                "VALUES (%s, %s, %s, %s, %s, %s)",
+                [
+                    (
+                        self.rowid(product.pk),
+                        str(product.pk),
+                        product.title,
+                        product.brand,
+                        product.manufacturer,
+                        strip_tags(product.description),
+                    )
+                    for product in products
+                ],
+            )
+
+    def remove(self, pks):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(
+                f"DELETE FROM {FTS_TABLE} WHERE rowid = %s",
+                [(self.rowid(pk),) for pk in pks],
+            )
+
+    def search(self, query, offset, limit):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        # every token must match, the last one as a prefix while typing
+        match = " ".join(f'"{token}"' for token in tokens) + "*"
+        wanted = offset + limit
+        candidates = wanted * 2
+        while True:
+            hits = self.rank(match, candidates)
+            visible = self.published(hits)
+            results = [pk for pk in hits if pk in visible]
+            if len(results) >= wanted or len(hits) < candidates:
+                return results[offset:wanted]
+            candidates *= 4
+
+    def rank(self, match, limit):
+        # ranking inside FTS5 alone is several times faster than joining
+        # the product table first, so unpublished hits are dropped after
+        weights = ", ".join(str(weight) for weight in self.weights)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT product_id FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+                f"ORDER BY bm25({FTS_TABLE}, {weights}), product_id LIMIT %s",
+                [match, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def published(self, pks, batch_size=900):
+        statuses = ", ".join(["%s"] * len(PUBLISHED_STATUSES))
+        published = set()
+        with connection.cursor() as cursor:
+            for start in range(0, len(pks), batch_size):
+                batch = pks[start : start + batch_size]
+                cursor.execute(
+                    "SELECT id FROM products_product "
+                    f"WHERE id IN ({', '.join(['%s'] * len(batch))}) "
+                    f"AND status IN ({statuses})",
+                    [*batch, *PUBLISHED_STATUSES],
+                )
+                published.update(row[0] for row in cursor.fetchall())
+        return published
+
+
+class PostgreSQLSearchBackend(SearchBackend):
+    """
+    GIN expression index over a weighted ``tsvector`` of the product row.
+
+    The index is maintained by PostgreSQL itself, so ``index`` and
+    ``remove`` have nothing to do.
+    """
+
+    config = "english"
+    index_name = "product_search_idx"
+
+    @property
+    def document(self):
+        return " || ".join(
+            f"setweight(to_tsvector('{self.config}', coalesce({field}, '')), '{weight}')"
+            for field, weight in zip(SEARCH_FIELDS, "ABBD")
+        )
+
+    def create_index(self, schema_editor):
+        schema_editor.execute(
+            f"CREATE INDEX {self.index_name} ON products_product "
+            f"USING GIN (({self.document}))"
+        )
+
+    def drop_index(self, schema_editor):
+        schema_editor.execute(f"DROP INDEX IF EXISTS {self.index_name}")
+
+    def search(self, query, offset, limit):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        statuses = ", ".join(["%s"] * len(PUBLISHED_STATUSES))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT id FROM products_product, "
+                f"to_tsquery('{self.config}', %s) query "
+                f"WHERE ({self.document}) @@ query AND status IN ({statuses}) "
+                f"ORDER BY ts_rank(({self.document}), query) DESC, id "
+                "LIMIT %s OFFSET %s",
+                [" & ".join(tokens) + ":*", *PUBLISHED_STATUSES, limit, offset],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class FallbackSearchBackend(SearchBackend):
+    """
+    Unranked ``icontains`` scan for databases without a full-text index.
+    """
+
+    def search(self, query, offset, limit):
+        from .models import Product
+
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        queryset = Product.published_objects.all()
+        for token in tokens:
+            condition = Q()
+            for field in SEARCH_FIELDS:
+                condition |= Q(**{f"{field}__icontains": token})
+            queryset = queryset.filter(condition)
+        return list(
+            queryset.order_by("id").values_list("id", flat=True)[
+                offset : offset + limit
+            ]
+        )
+
+
+BACKENDS = {
+    "sqlite": SQLiteSearchBackend,
+    "postgresql": PostgreSQLSearchBackend,
+}
+
+
+def get_search_backend(vendor=None):
+    return BACKENDS.get(vendor or connection.vendor, FallbackSearchBackend)()
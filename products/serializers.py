@@ -1,8 +1,15 @@
+import decimal
+
+from django.core.files.storage import FileSystemStorage
+from django.db import models
+from django.utils.encoding import filepath_to_uri
 from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer
+from rest_framework.settings import api_settings
 
 from accounts.serializers import UserDataSerializer
 
+from .cache import get_category_paths
 from .models import *
 
 
@@ -32,10 +39,241 @@ class SuperCategorySerializer(ModelSerializer):
         return None
 
 
+class CategoryPathField(serializers.Field):
+    """
+    Base for fields rendered from the precomputed category path map, so
+    products never load their category chain from the database.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["source"] = "category_id"
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    def get_path(self, category_id):
+        root = self.root
+        if not hasattr(root, "_category_paths"):
+            root._category_paths = get_category_paths()
+        return root._category_paths.get(category_id, ())
+
+
+class SuperCategoryField(CategoryPathField):
+    """
+    Same output as ``SuperCategorySerializer`` for the product category.
+    """
+
+    def to_representation(self, value):
+        category = None
+        for id, title in self.get_path(value):
+            category = {"id": id, "title": title, "sup_category": category}
+        return category
+
+
+class BreadcrumbField(CategoryPathField):
+    def to_representation(self, value):
+        return [{"id": id, "title": title} for id, title in self.get_path(value)]
+
+
+def get_list_param(request, name):
+    value = request.query_params.get(name, "") if request is not None else ""
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+class SparseFieldsetMixin:
+    """
+    Render only the fields asked for with ``?fields=a,b``, or else the
+    ``Meta.default_fields`` (all fields if unset) plus any listed in
+    ``?include=c,d``.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+
+        names = get_list_param(request, "fields")
+        if not names:
+            names = getattr(self.Meta, "default_fields", fields)
+            names = [*names, *get_list_param(request, "include")]
+        return {name: field for name, field in fields.items() if name in names}
+
+    def get_only_fields(self):
+        """
+        Model fields needed to render the selected fields, for ``only()``.
+        """
+        only = ["pk"]
+        for field in self.fields.values():
+            if field.source == "*":
+                continue
+            source = field.source.replace(".", "__")
+            if isinstance(field, serializers.BaseSerializer):
+                only += [f"{source}__{child.source}" for child in field.fields.values()]
+            else:
+                only.append(source)
+        return only
+
+
+class ValuesListSerializer(serializers.ListSerializer):
+    """
+    ``ListSerializer`` that also renders ``.values()`` rows.
+
+    Every field gets a converter built once per list, so rows skip model
+    instantiation and the per-field ``get_attribute``/``to_representation``
+    calls. The output is the same as for model instances, which are still
+    rendered the usual way.
+    """
+
+    def values(self, queryset, *fields):
+        """
+        ``queryset`` as rows holding what the child serializer renders,
+        plus ``fields``.
+        """
+        converters = self.get_converters(self.child)
+        lookups = [lookup for _, lookups, _ in converters for lookup in lookups]
+        return queryset.values(*dict.fromkeys([*lookups, *fields]))
+
+    def to_representation(self, data):
+        rows = list(data.all() if isinstance(data, models.Manager) else data)
+        if not rows or not isinstance(rows[0], dict):
+            return super().to_representation(rows)
+
+        converters = [
+            (name, convert) for name, _, convert in self.get_converters(self.child)
+        ]
+        return [{name: convert(row) for name, convert in converters} for row in rows]
+
+    def get_converters(self, serializer, prefix=""):
+        """
+        ``(field name, value lookups, row converter)`` for every field.
+        """
+        model = serializer.Meta.model
+        converters = []
+        for name, field in serializer.fields.items():
+            if field.source == "*" or isinstance(
+                field, (serializers.ListSerializer, serializers.RelatedField)
+            ):
+                raise TypeError(f"{name} can't be rendered from values")
+
+            lookup = prefix + field.source.replace(".", "__")
+            if isinstance(field, serializers.Serializer):
+                pk = f"{lookup}__{field.Meta.model._meta.pk.name}"
+                children = self.get_converters(field, f"{lookup}__")
+                lookups = [
+                    pk,
+                    *(lookup for _, lookups, _ in children for lookup in lookups),
+                ]
+                converters.append((name, lookups, nested_converter(pk, children)))
+            else:
+                convert = self.get_converter(model, lookup[len(prefix) :], field)
+                converters.append((name, [lookup], value_converter(lookup, convert)))
+        return converters
+
+    def get_converter(self, model, lookup, field):
+        if isinstance(field, serializers.DecimalField) and not field.localize:
+            coerce_to_string = getattr(
+                field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING
+            )
+            if not coerce_to_string:
+                return field.quantize
+            context = decimal.getcontext().copy()
+            context.prec = field.max_digits or context.prec
+            exponent = decimal.Decimal(".1") ** field.decimal_places
+            rounding = field.rounding
+            return lambda value: "{:f}".format(
+                value.quantize(exponent, rounding=rounding, context=context)
+            )
+
+        use_url = getattr(field, "use_url", api_settings.UPLOADED_FILES_USE_URL)
+        if isinstance(field, serializers.FileField) and use_url:
+            storage = get_model_field(model, lookup).storage
+            return file_url_converter(storage, self.context.get("request"))
+
+        if type(field) in (serializers.CharField, serializers.SlugField):
+            return str
+        return field.to_representation
+
+
+def value_converter(lookup, convert):
+    return lambda row: None if row[lookup] is None else convert(row[lookup])
+
+
+def nested_converter(pk, children):
+    def convert(row):
+        if row[pk] is None:
+            return None
+        return {name: convert(row) for name, _, convert in children}
+
+    return convert
+
+
+def file_url_converter(storage, request):
+    def url(name):
+        if not name:
+            return None
+        if request is None:
+            return storage.url(name)
+        return request.build_absolute_uri(storage.url(name))
+
+    base_url = getattr(storage, "base_url", "")
+    if (
+        getattr(storage.url, "__func__", None) is not FileSystemStorage.url
+        or not base_url.startswith("/")
+        or not base_url.endswith("/")
+    ):
+        return url
+
+    # FileSystemStorage.url() is base_url + quoted name, and absolute URLs
+    # of it share one prefix; urljoin() and build_absolute_uri() are only
+    # needed for names with a scheme or dot segments
+    prefix = base_url if request is None else request.build_absolute_uri(base_url)
+
+    def fast_url(name):
+        if not name:
+            return None
+        path = filepath_to_uri(name).lstrip("/")
+        if ":" in path or "/." in f"/{path}":
+            return url(name)
+        return prefix + path
+
+    return fast_url
+
+
+def get_model_field(model, lookup):
+    *relations, name = lookup.split("__")
+    for relation in relations:
+        model = model._meta.get_field(relation).related_model
+    return model._meta.get_field(name)
+
+
 class ProductCreateSerializer(ModelSerializer):
     class Meta:
         model = Product
-        exclude = ["owner", "published_at", "created_at"]
+        exclude = ["owner", "published_at", "created_at", "stock_alert_at"]
+
+
+class ProductBulkUpdateSerializer(serializers.Serializer):
+    """
+    One item of a bulk price and stock update, naming the product by
+    ``id`` or ``slug``.
+    """
+
+    FIELDS = ["price", "discount_price", "quantity"]
+
+    id = serializers.CharField(required=False)
+    slug = serializers.CharField(required=False)
+    price = serializers.DecimalField(max_digits=12, decimal_places=2, required=False)
+    discount_price = serializers.DecimalField(
+        max_digits=12, decimal_places=2, allow_null=True, required=False
+    )
+    quantity = serializers.IntegerField(min_value=0, required=False)
+
+    def validate(self, attrs):
+        if not attrs.get("id") and not attrs.get("slug"):
+            raise serializers.ValidationError("Either id or slug is required.")
+        if not any(field in attrs for field in self.FIELDS):
+            raise serializers.ValidationError(
+                f"Nothing to update, send any of {', '.join(self.FIELDS)}."
+            )
+        return attrs
 
 
 class ProductImageSerializer(ModelSerializer):
@@ -44,14 +282,37 @@ class ProductImageSerializer(ModelSerializer):
         exclude = ["id", "product"]
 
 
-class ProductSerializer(ModelSerializer):
-    category = SuperCategorySerializer()
+class ProductSerializer(SparseFieldsetMixin, ModelSerializer):
+    category = SuperCategoryField()
+    breadcrumb = BreadcrumbField()
     images = ProductImageSerializer()
 
     class Meta:
         model = Product
-        exclude = ["owner", "published_at", "created_at"]
+        exclude = ["owner", "published_at", "created_at", "stock_alert_at"]
         depth = 1
+        list_serializer_class = ValuesListSerializer
+
+
+class ProductListSerializer(ProductSerializer):
+    """
+    Compact product for list endpoints, without the description and the
+    full image set unless asked for with ``?include=``.
+    """
+
+    thumbnail = serializers.ImageField(source="images.thumbnail", read_only=True)
+
+    class Meta(ProductSerializer.Meta):
+        default_fields = [
+            "id",
+            "slug",
+            "title",
+            "price",
+            "discount_price",
+            "status",
+            "thumbnail",
+            "breadcrumb",
+        ]
 
 
 class CartSerializer(ModelSerializer):
@@ -62,3 +323,89 @@ class CartSerializer(ModelSerializer):
         model = Cart
         fields = "__all__"
         depth = 1
+        extra_kwargs = {"quantity": {"min_value": 1}}
+
+
+class CartOperationSerializer(serializers.Serializer):
+    """
+    One operation of a batch cart change: ``add`` to or ``set`` the
+    quantity of the product with ``slug``, or ``remove`` its line.
+    """
+
+    OPERATIONS = ["add", "set", "remove"]
+
+    slug = serializers.CharField()
+    op = serializers.ChoiceField(choices=OPERATIONS, default="add")
+    quantity = serializers.IntegerField(min_value=0, required=False)
+
+    def validate(self, attrs):
+        if attrs["op"] != "remove" and "quantity" not in attrs:
+            raise serializers.ValidationError(
+                {"quantity": [f"This field is required to {attrs['op']}."]}
+            )
+        return attrs
+
+
+class CartProductSerializer(ModelSerializer):
+    thumbnail = serializers.ImageField(source="images.thumbnail", read_only=True)
+
+    class Meta:
+        model = Product
+        fields = [
+            "id",
+            "slug",
+            "title",
+            "price",
+            "discount_price",
+            "effective_price",
+            "thumbnail",
+        ]
+
+
+class CartLineSerializer(ModelSerializer):
+    """
+    A cart line with only what a cart renders, from the ``.values()`` of
+    ``CartQuerySet.with_totals()``.
+    """
+
+    product = CartProductSerializer()
+    line_total = serializers.DecimalField(
+        max_digits=14, decimal_places=2, read_only=True
+    )
+    available = serializers.BooleanField(read_only=True)
+
+    class Meta:
+        model = Cart
+        fields = ["id", "product", "quantity", "line_total", "available"]
+        list_serializer_class = ValuesListSerializer
+
+
+class CartTotalsSerializer(serializers.Serializer):
+    items = serializers.IntegerField()
+    subtotal = serializers.DecimalField(max_digits=14, decimal_places=2)
+    discount = serializers.DecimalField(max_digits=14, decimal_places=2)
+    total = serializers.DecimalField(max_digits=14, decimal_places=2)
+
+
+class OrderItemSerializer(ModelSerializer):
+    product = serializers.SlugRelatedField(slug_field="slug", read_only=True)
+
+    class Meta:
+        model = OrderItem
+        fields = ["product", "seller", "title", "price", "unit_price", "quantity"]
+
+
+class OrderSerializer(ModelSerializer):
+    items = OrderItemSerializer(many=True)
+
+    class Meta:
+        model = Order
+        fields = [
+            "id",
+            "status",
+            "subtotal",
+            "discount",
+            "total",
+            "created_at",
+            "items",
+        ]
@@ -1,17 +1,39 @@
-from django.db.models.signals import post_save, pre_save
-from django.dispatch import receiver
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import Signal, receiver
 from django.utils import timezone
+from mptt.signals import node_moved
 
-from .models import Product
+from .cache import (
+    CATALOG_VERSION_KEY,
+    CATEGORY_VERSION_KEY,
+    adjust_facet_counts,
+    bump_version,
+    delete_facet_counts,
+    get_product_version_key,
+)
+from .managers import FACET_FIELDS, PUBLISHED_STATUSES
+from .models import Category, Product, ProductImage
+from .search import get_search_backend
 from .utils import send_mail_to_product_owner_for_out_of_stack
 
+# Sent instead of post_save by bulk writes, with the ``products`` written
+# and whether they were ``created``.
+products_bulk_changed = Signal()
+
+# Sent by checkout, with the ``slugs`` of the products whose stock it
+# took and whether any of them went ``out_of_stock``.
+products_stock_changed = Signal()
+
 
 @receiver(post_save, sender=Product)
 def send_mail_for_out_of_stack(sender, instance, created, *args, **kwargs):
-    if instance.quantity == 0 and instance.status == "published":
-        instance.status = "out_of_stack"
-        instance.published_at = None
-        instance.save()
+    # the status itself was moved by Product.save(), in the same UPDATE;
+    # with STOCK_DIGEST the owner hears about it in the next digest instead
+    if getattr(instance, "_stocked_out", False) and not settings.STOCK_DIGEST:
         send_mail_to_product_owner_for_out_of_stack(instance)
 
 
@@ -19,3 +41,117 @@ def send_mail_for_out_of_stack(sender, instance, created, *args, **kwargs):
 def update_published_time(sender, instance, *args, **kwargs):
     if instance.status == "published" and not instance.published_at:
         instance.published_at = timezone.now()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(node_moved, sender=Category)
+def invalidate_category_cache(sender, instance, *args, **kwargs):
+    # after the commit, or a read in between caches the old tree under the
+    # new version
+    transaction.on_commit(bump_category_versions)
+
+
+def bump_category_versions():
+    bump_version(CATEGORY_VERSION_KEY)
+    bump_version(CATALOG_VERSION_KEY)
+
+
+def bump_product_versions(slugs):
+    for slug in slugs:
+        bump_version(get_product_version_key(slug))
+    bump_version(CATALOG_VERSION_KEY)
+
+
+def bump_product_versions_on_commit(slugs):
+    # a read before the commit would cache the old row under the new version
+    transaction.on_commit(partial(bump_product_versions, slugs))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_cache(sender, instance, *args, **kwargs):
+    old_slug = getattr(instance, "_loaded_values", {}).get("slug")
+    slugs = {old_slug, instance.slug} - {None, ""}
+    bump_product_versions_on_commit(slugs)
+
+
+@receiver(products_bulk_changed, sender=Product)
+def invalidate_bulk_product_cache(sender, products, created, *args, **kwargs):
+    # new products have nothing cached under their own version yet
+    bump_product_versions([] if created else [product.slug for product in products])
+
+
+@receiver(products_stock_changed, sender=Product)
+def invalidate_stock_cache(sender, slugs, out_of_stock, *args, **kwargs):
+    bump_product_versions(slugs)
+    # only the status facet can change, and only on a stock-out
+    if out_of_stock:
+        delete_facet_counts()
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def invalidate_product_image_cache(sender, instance, *args, **kwargs):
+    slug = (
+        Product.objects.filter(pk=instance.product_id)
+        .values_list("slug", flat=True)
+        .first()
+    )
+    if slug is not None:
+        bump_product_versions_on_commit([slug])
+
+
+@receiver(post_save, sender=Product)
+def update_search_index(sender, instance, *args, **kwargs):
+    get_search_backend().index([instance])
+
+
+@receiver(products_bulk_changed, sender=Product)
+def update_bulk_search_index(sender, products, *args, **kwargs):
+    get_search_backend().index(products)
+
+
+@receiver(post_delete, sender=Product)
+def remove_from_search_index(sender, instance, *args, **kwargs):
+    get_search_backend().remove([instance.pk])
+
+
+def get_facet_values(values):
+    if values.get("status") not in PUBLISHED_STATUSES:
+        return None
+    return {facet: values.get(field) for facet, field in FACET_FIELDS.items()}
+
+
+def get_loaded_facet_values(instance):
+    """
+    Facet values ``instance`` had in the database, raising ``KeyError``
+    when they are unknown, e.g. it was not loaded or only partially.
+    """
+    loaded = getattr(instance, "_loaded_values", {})
+    return get_facet_values({field: loaded[field] for field in FACET_FIELDS.values()})
+
+
+@receiver(post_save, sender=Product)
+def update_facet_counts(sender, instance, created, *args, **kwargs):
+    values = {field: getattr(instance, field) for field in FACET_FIELDS.values()}
+    try:
+        old = None if created else get_loaded_facet_values(instance)
+    except KeyError:
+        delete_facet_counts()
+    else:
+        adjust_facet_counts(old, get_facet_values(values))
+
+
+@receiver(post_delete, sender=Product)
+def remove_from_facet_counts(sender, instance, *args, **kwargs):
+    try:
+        adjust_facet_counts(get_loaded_facet_values(instance), None)
+    except KeyError:
+        delete_facet_counts()
+
+
+@receiver(products_bulk_changed, sender=Product)
+def reset_facet_counts(sender, products, *args, **kwargs):
+    # rebuilt by the next request, cheaper than adjusting row by row
+    delete_facet_counts()
@@ -0,0 +1,8 @@
+from celery import shared_task
+
+from .utils import send_stock_digests
+
+
+@shared_task
+def send_stock_digests_task():
+    return send_stock_digests()
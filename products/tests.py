@@ -1,24 +1,87 @@
-from django.test import TestCase
+import io
+import json
+import random
+import threading
+import time
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+
+from accounts.models import BuyerProfile, SellerProfie
+from outbox.models import OutboxEmail
+from outbox.utils import send_outbox
+from utils.testing import QueryBudgetMixin
 
+from .cache import SingleFlight
+from .checkout import CheckoutError, checkout, create_order, refund
+from .checks import check_shared_cache
+from .ids import BlockIDAllocator
+from .managers import CartQuerySet
 from .models import *
+from .profiles import reconcile_buyers, reconcile_sellers
+from .search import get_search_backend
+from .serializers import (
+    CategorySerializer,
+    ProductListSerializer,
+    ProductSerializer,
+    SuperCategorySerializer,
+)
+from .utils import generate_titles_to_slugs, send_stock_digests
+from .views import ProductSearchView, SellerProductsView
+
 
+class ProductFactoryMixin:
+    """
+    Test case mixin creating a seller and a category in ``setUp()``, and
+    published products for them with ``create_product()``.
+    """
 
-class ProductModelTests(TestCase):
     def setUp(self):
-        self.seller1 = User.objects.create_user(
-            "seller1", email="seller1@email.com", password="1234@#$%", role="seller"
-        )
-        self.seller2 = User.objects.create_user(
-            "seller2", email="seller2@email.com", password="1234@#$%", role="seller"
+        super().setUp()
+        self.seller = self.create_seller("seller")
+        self.category = Category.objects.create(title="phone")
+
+    def create_seller(self, username):
+        return User.objects.create_user(
+            username,
+            email=f"{username}@email.com",
+            password="1234@#$%",
+            role="seller",
         )
-        self.category = Category.objects.create(title="food")
+
+    def create_product(self, title, **kwargs):
+        fields = {
+            "owner": self.seller,
+            "category": self.category,
+            "price": 10,
+            "quantity": 5,
+            "description": "description",
+            "status": "published",
+        }
+        return Product.objects.create(title=title, **{**fields, **kwargs})
+
+
+class ProductModelTests(ProductFactoryMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_seller("other")
 
     def test_product_create(self):
         product = Product.objects.create(
-            owner=self.seller1,
+            owner=self.seller,
             category=self.category,
             title="title",
             price=23.6,
@@ -33,7 +96,7 @@ class ProductModelTests(TestCase):
 
     def test_unique_slug(self):
         product1 = Product.objects.create(
-            owner=self.seller1,
+            owner=self.seller,
             category=self.category,
             title="title",
             price=23.6,
@@ -41,7 +104,7 @@ class ProductModelTests(TestCase):
             description="this is description",
         )
         product2 = Product.objects.create(
-            owner=self.seller2,
+            owner=self.other,
             category=self.category,
             title="title",
             price=23.6,
@@ -52,8 +115,77 @@ class ProductModelTests(TestCase):
         self.assertEqual(product1.slug, slugify("title"))
         self.assertNotEqual(product2.slug, slugify("title"))
 
+    def test_slug_suffixes(self):
+        self.create_product("Phone case")
+        self.create_product("Phone case")
+        self.create_product("Phone case 1")
+        Product.objects.filter(slug="phone-case-1").update(slug="phone-case-3")
+
+        with self.assertNumQueries(1):
+            slugs = generate_titles_to_slugs(
+                Product,
+                ["Phone case", "Phone case", "Phone case 1", "Phone"],
+                exclude=["phone-case-2"],
+            )
+
+        self.assertEqual(
+            slugs, ["phone-case-1", "phone-case-4", "phone-case-1-2", "phone"]
+        )
+
+    def test_slug_race_is_retried(self):
+        self.create_product("Phone case")
+        allocate = mock.Mock(side_effect=["phone-case", "phone-case-1"])
+
+        with mock.patch("products.models.generate_title_to_slug", allocate):
+            product = self.create_product("Phone case")
+
+        self.assertEqual(product.slug, "phone-case-1")
+        self.assertEqual(allocate.call_count, 2)
 
-class ProductAPIViewTests(APITestCase):
+    def test_effective_price(self):
+        product = self.create_product("Phone case", price=Decimal("23.60"))
+        self.assertEqual(product.effective_price, Decimal("23.6"))
+        self.assertEqual(product.discount_percent, 0)
+
+        product.discount_price = Decimal("17.70")
+        product.save(update_fields=["discount_price"])
+        product.refresh_from_db()
+        self.assertEqual(product.effective_price, Decimal("17.70"))
+        self.assertEqual(product.discount_percent, 25)
+
+        product.price = Decimal("35.40")
+        Product.objects.bulk_update([product], ["price"])
+        product.refresh_from_db()
+        self.assertEqual(product.discount_percent, 50)
+
+    def test_stock_out_is_one_write(self):
+        product = self.create_product("Phone case")
+        OutboxEmail.objects.all().delete()
+
+        product.quantity = 0
+        with CaptureQueriesContext(connection) as context:
+            product.save()
+
+        updates = [
+            query["sql"]
+            for query in context
+            if query["sql"].startswith('UPDATE "products_product"')
+        ]
+        self.assertEqual(len(updates), 1)
+        product.refresh_from_db()
+        self.assertEqual(product.status, "out_of_stack")
+        self.assertIsNone(product.published_at)
+        self.assertEqual(OutboxEmail.objects.get().subject, "Out of Stack")
+
+        product.quantity = 5
+        product.save(update_fields=["quantity"])
+        product.refresh_from_db()
+        self.assertEqual(product.status, "published")
+        self.assertIsNotNone(product.published_at)
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+
+
+class ProductAPIViewTests(QueryBudgetMixin, APITestCase):
     login_url = reverse("accounts:token")
 
     def setUp(self):
@@ -114,12 +246,218 @@ class ProductAPIViewTests(APITestCase):
         access = response.data["access"]
         self.client.credentials(HTTP_AUTHORIZATION="Bearer " + access)
 
+    def add_products(self, owner, count=5):
+        for number in range(count):
+            product = Product.objects.create(
+                owner=owner,
+                category=self.category,
+                title=f"extra {number}",
+                price=23.6,
+                quantity=23,
+                description="this is description",
+                status="published",
+            )
+            ProductImage.objects.create(product=product)
+            Cart.objects.create(user=self.buyer, product=product, quantity=1)
+
     def test_product_list(self):
         response = self.client.get(reverse("products:list"))
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), Product.published_objects.all().count())
 
+    def test_product_list_keyset_pagination(self):
+        Product.objects.create(
+            owner=self.seller2,
+            category=self.category,
+            title="title4",
+            price=23.6,
+            quantity=0,
+            description="this is description",
+            status="published",
+        )
+        url = reverse("products:list") + "?page_size=2"
+        slugs = []
+
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            for query in context:
+                self.assertNotIn("OFFSET", query["sql"])
+                self.assertNotIn("COUNT(", query["sql"])
+            slugs += [product["slug"] for product in response.data["results"]]
+            url = response.data["next"]
+
+            # rows published meanwhile must not shift the following pages
+            Product.objects.create(
+                owner=self.seller1,
+                category=self.category,
+                title="new",
+                price=23.6,
+                quantity=23,
+                description="this is description",
+                status="published",
+            )
+
+        self.assertEqual(slugs, ["title3", "title2", "title", "title4"])
+
+    def test_product_list_invalid_cursor(self):
+        response = self.client.get(reverse("products:list") + "?cursor=invalid")
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_product_list_query_budget(self):
+        self.assertQueriesDoNotScale(
+            lambda: self.client.get(reverse("products:list")),
+            lambda: self.add_products(self.seller1),
+            budget=1,
+        )
+
+    def test_product_detail_query_budget(self):
+        url = reverse("products:detail", kwargs={"slug": self.product1.slug})
+        ProductImage.objects.create(product=self.product1)
+        self.client.get(url)
+        # miss the response cache without invalidating the breadcrumb map
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product1.save()
+
+        with self.assertNumQueries(1):
+            self.client.get(url)
+
+    def test_seller_product_list_query_budget(self):
+        self.login_seller1()
+
+        self.assertQueriesDoNotScale(
+            lambda: self.client.get(reverse("products:seller_list")),
+            lambda: self.add_products(self.seller1),
+            budget=2,
+        )
+
+    def test_add_to_cart(self):
+        self.login_buyer()
+        url = reverse("products:cart", kwargs={"slug": self.product1.slug})
+
+        with self.assertNumQueries(2):
+            response = self.client.post(url, {"quantity": 2}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(url, {"quantity": 3}, format="json")
+
+        self.assertEqual(response.data["quantity"], 5)
+        self.assertEqual(response.data["product"], self.product1.id)
+        self.assertEqual(Cart.objects.get(user=self.buyer).quantity, 5)
+
+        url = reverse("products:cart", kwargs={"slug": "missing"})
+        response = self.client.post(url, {"quantity": 3}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cart_routes_only_allow_their_methods(self):
+        self.login_buyer()
+        url = reverse("products:cart", kwargs={"slug": self.product1.slug})
+
+        response = self.client.post(reverse("products:cart_list"), {"quantity": 2})
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    def test_cart_summary(self):
+        self.product2.discount_price = Decimal("20.00")
+        self.product2.save()
+        self.product3.quantity = 1
+        self.product3.save()
+        Cart.objects.create(user=self.buyer, product=self.product1, quantity=2)
+        Cart.objects.create(user=self.buyer, product=self.product2, quantity=1)
+        Cart.objects.create(user=self.buyer, product=self.product3, quantity=3)
+        self.client.force_authenticate(self.buyer)
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("products:cart_summary"))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lines = response.data["lines"]
+        self.assertEqual(
+            [(line["product"]["slug"], line["line_total"]) for line in lines],
+            [("title", "47.20"), ("title2", "20.00"), ("title3", "70.80")],
+        )
+        self.assertEqual([line["available"] for line in lines], [True, True, False])
+        self.assertEqual(response.data["items"], 6)
+        self.assertEqual(response.data["subtotal"], "141.60")
+        self.assertEqual(response.data["discount"], "3.60")
+        self.assertEqual(response.data["total"], "138.00")
+
+        Cart.objects.all().delete()
+        response = self.client.get(reverse("products:cart_summary"))
+        self.assertEqual(response.data["lines"], [])
+        self.assertEqual(response.data["total"], "0.00")
+
+    def test_cart_batch(self):
+        Cart.objects.create(user=self.buyer, product=self.product1, quantity=2)
+        Cart.objects.create(user=self.buyer, product=self.product2, quantity=1)
+        self.client.force_authenticate(self.buyer)
+        operations = [
+            {"slug": "title", "quantity": 3},
+            {"slug": "title2", "op": "remove"},
+            {"slug": "title3", "op": "set", "quantity": 4},
+            {"slug": "title3", "quantity": 1},
+        ]
+
+        response = self.client.post(
+            reverse("products:cart_batch"), operations, format="json"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [
+                (line["product"]["slug"], line["quantity"])
+                for line in response.data["lines"]
+            ],
+            [("title", 5), ("title3", 5)],
+        )
+        self.assertEqual(response.data["items"], 10)
+
+        operations = [{"slug": "title", "op": "set"}, {"slug": "missing"}]
+        response = self.client.post(
+            reverse("products:cart_batch"), operations, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("quantity", response.data[0])
+
+        operations = [
+            {"slug": "title", "op": "set", "quantity": 0},
+            {"slug": "missing", "quantity": 1},
+        ]
+        response = self.client.post(
+            reverse("products:cart_batch"), operations, format="json"
+        )
+        self.assertEqual(response.data, [{}, {"slug": ["Product not found."]}])
+        self.assertEqual(Cart.objects.filter(user=self.buyer).count(), 2)
+
+    def test_cart_batch_query_count(self):
+        self.client.force_authenticate(self.buyer)
+        operations = [
+            {"slug": product.slug, "quantity": 1}
+            for product in [self.product1, self.product2, self.product3]
+        ]
+        self.client.post(reverse("products:cart_batch"), operations[:1], format="json")
+
+        # products, lines, savepoint and release, insert, delete, two for summary
+        with self.assertNumQueries(8):
+            self.client.post(
+                reverse("products:cart_batch"),
+                [*operations, {"slug": self.product1.slug, "op": "remove"}],
+                format="json",
+            )
+
+    def test_cart_query_budget(self):
+        self.login_buyer()
+        Cart.objects.create(user=self.buyer, product=self.product1, quantity=1)
+
+        self.assertQueriesDoNotScale(
+            lambda: self.client.get(reverse("products:cart_list")),
+            lambda: self.add_products(self.seller1),
+            budget=2,
+        )
+
     def test_product_detail(self):
         response = self.client.get(
             reverse("products:detail", kwargs={"slug": self.product1.slug})
@@ -129,6 +467,144 @@ class ProductAPIViewTests(APITestCase):
         self.assertEqual(response.data["title"], self.product1.title)
         self.assertEqual(response.data["status"], self.product1.status)
 
+    def test_product_breadcrumb(self):
+        cache.clear()
+        fruit = Category.objects.create(title="fruit", parent=self.category)
+        apple = Category.objects.create(title="apple", parent=fruit)
+        green = Category.objects.create(title="green", parent=apple)
+        Product.objects.update(category=green)
+
+        with CaptureQueriesContext(connection) as context:
+            data = ProductSerializer(Product.objects.all(), many=True).data
+        category_queries = [
+            query for query in context if "products_category" in query["sql"]
+        ]
+        self.assertEqual(len(category_queries), 1)
+        self.assertEqual(data[0]["category"], SuperCategorySerializer(green).data)
+        self.assertEqual(
+            [node["title"] for node in data[0]["breadcrumb"]],
+            ["food", "fruit", "apple", "green"],
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            fruit.title = "fruits"
+            fruit.save()
+        data = ProductSerializer(Product.objects.get(pk=self.product1.pk)).data
+        self.assertEqual(data["breadcrumb"][1], {"id": fruit.id, "title": "fruits"})
+
+    def test_product_detail_conditional_get(self):
+        cache.clear()
+        url = reverse("products:detail", kwargs={"slug": self.product1.slug})
+        response = self.client.get(url)
+        etag = response["ETag"]
+        last_modified = response["Last-Modified"]
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductImage.objects.create(product=self.product1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+        etag = response["ETag"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.title = "drinks"
+            self.category.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_product_detail_cache(self):
+        cache.clear()
+        url = reverse("products:detail", kwargs={"slug": self.product1.slug})
+        self.client.get(url)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.data["title"], self.product1.title)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product1.price = 12
+            self.product1.save()
+            # nothing is invalidated before the write commits
+            response = self.client.get(url)
+            self.assertEqual(response.data["price"], "23.60")
+        response = self.client.get(url)
+        self.assertEqual(response.data["price"], "12.00")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product1.status = "draft"
+            self.product1.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_product_list_sparse_fieldsets(self):
+        url = reverse("products:list")
+        ProductImage.objects.create(product=self.product1)
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(
+            set(response.data[0]), set(ProductListSerializer.Meta.default_fields)
+        )
+        self.assertIsNone(response.data[0]["thumbnail"])
+        self.assertNotIn("description", context[0]["sql"])
+
+        response = self.client.get(url + "?include=description,quantity")
+        self.assertEqual(response.data[0]["description"], "this is description")
+        self.assertEqual(response.data[0]["quantity"], 23)
+
+        response = self.client.get(url + "?fields=slug,price")
+        self.assertEqual(dict(response.data[0]), {"slug": "title3", "price": "23.60"})
+
+    def test_product_detail_sparse_fieldsets(self):
+        url = reverse("products:detail", kwargs={"slug": self.product1.slug})
+        full = self.client.get(url)
+        sparse = self.client.get(url + "?fields=title,price")
+
+        self.assertIn("description", full.data)
+        self.assertEqual(sparse.data, {"title": "title", "price": "23.60"})
+        self.assertNotEqual(full["ETag"], sparse["ETag"])
+
+        internal = self.client.get(url + "?fields=title,stock_alert_at")
+        self.assertNotIn("stock_alert_at", full.data)
+        self.assertEqual(internal.data, {"title": "title"})
+
+    def test_values_rendering_matches_instances(self):
+        self.add_products(self.seller1, count=2)
+        ProductImage.objects.filter(product__title="extra 0").update(
+            thumbnail="thumbnails/extra 0.png", image_1="../images/extra:0.png"
+        )
+        Product.objects.filter(pk=self.product2.pk).update(discount_price=9.5)
+        request = Request(APIRequestFactory().get("/?include=description"))
+        queryset = Product.objects.with_related().order_by("pk")
+
+        for serializer_class in [ProductSerializer, ProductListSerializer]:
+            context = {"request": request}
+            rows = serializer_class(many=True, context=context).values(queryset)
+            fast = serializer_class(rows, many=True, context=context).data
+            slow = serializer_class(queryset, many=True, context=context).data
+            self.assertEqual(JSONRenderer().render(fast), JSONRenderer().render(slow))
+
+    def test_catalog_conditional_get(self):
+        url = reverse("products:list")
+        etag = self.client.get(url)["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(url + "?brand=x", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product3.price = 10
+            self.product3.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
     def test_seller_own_product_list(self):
         self.login_seller1()
 
@@ -140,6 +616,21 @@ class ProductAPIViewTests(APITestCase):
             Product.published_objects.filter(owner=self.seller1).count(),
         )
 
+    def test_seller_product_list_stream(self):
+        self.login_seller1()
+        self.add_products(self.seller1)
+        url = reverse("products:seller_list")
+
+        with mock.patch.object(SellerProductsView, "stream_chunk_size", 2):
+            response = self.client.get(url + "?stream=1")
+            chunks = list(response.streaming_content)
+
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(len(chunks), 6)
+        streamed = json.loads(b"".join(chunks))
+        expected = json.loads(self.client.get(url).content)
+        self.assertEqual(streamed, expected)
+
     def test_seller_own_product_detail(self):
         self.login_seller2()
 
@@ -150,6 +641,18 @@ class ProductAPIViewTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data["title"], self.product3.title)
 
+    def test_seller_product_detail_sparse_fieldsets(self):
+        self.login_seller2()
+        url = reverse("products:seller_detail", kwargs={"slug": self.product3.slug})
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url + "?fields=slug,price")
+        self.assertEqual(dict(response.data), {"slug": "title3", "price": "23.60"})
+        self.assertNotIn("description", context[-1]["sql"])
+
+        response = self.client.patch(url + "?fields=price", {"price": "5"})
+        self.assertEqual(response.data, {"price": "5.00"})
+
     def test_other_seller_product_detail(self):
         self.login_seller2()
 
@@ -158,3 +661,900 @@ class ProductAPIViewTests(APITestCase):
         )
 
         self.assertNotEqual(response.status_code, status.HTTP_200_OK)
+
+
+class CategoryAPIViewTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.food = Category.objects.create(title="food")
+        self.fruit = Category.objects.create(title="fruit", parent=self.food)
+        self.apple = Category.objects.create(title="apple", parent=self.fruit)
+        self.book = Category.objects.create(title="book")
+
+    def test_category_tree(self):
+        response = self.client.get(reverse("products:category"))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            CategorySerializer(Category.objects.viewable(), many=True).data,
+        )
+
+    def test_category_tree_is_cached(self):
+        with self.assertNumQueries(1):
+            self.client.get(reverse("products:category"))
+
+        with self.assertNumQueries(0):
+            self.client.get(reverse("products:category"))
+
+    def test_category_tree_conditional_get(self):
+        url = reverse("products:category")
+        etag = self.client.get(url)["ETag"]
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book.delete()
+            # the old tree stays current until the delete commits
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_category_tree_invalidation(self):
+        self.client.get(reverse("products:category"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(title="banana", parent=self.fruit)
+        response = self.client.get(reverse("products:category"))
+        fruit = response.data[1]["sub_category"][0]
+        self.assertEqual(
+            [node["title"] for node in fruit["sub_category"]], ["apple", "banana"]
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.apple.move_to(self.book)
+        response = self.client.get(reverse("products:category"))
+        self.assertEqual(response.data[0]["sub_category"][0]["title"], "apple")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book.delete()
+        response = self.client.get(reverse("products:category"))
+        self.assertEqual([node["title"] for node in response.data], ["food"])
+
+
+class ProductSearchTests(ProductFactoryMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.case = self.create_product(
+            "iPhone case", description="<p>silicone cover</p>"
+        )
+        self.charger = self.create_product(
+            "USB charger", description="<p>for any iphone</p>"
+        )
+        self.draft = self.create_product(
+            "iPhone stand", description="desk", status="draft"
+        )
+
+    def search(self, query, **params):
+        response = self.client.get(reverse("products:search"), {"q": query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_search_ranking(self):
+        response = self.search("iphone")
+
+        self.assertEqual(
+            [product["slug"] for product in response.data["results"]],
+            [self.case.slug, self.charger.slug],
+        )
+
+    def test_search_prefix_and_html(self):
+        self.assertEqual(len(self.search("silic").data["results"]), 1)
+        self.assertEqual(len(self.search("p").data["results"]), 0)
+        self.assertEqual(len(self.search("").data["results"]), 0)
+
+    def test_search_index_sync(self):
+        self.draft.status = "published"
+        self.draft.save()
+        self.assertEqual(len(self.search("stand").data["results"]), 1)
+
+        self.case.title = "Android case"
+        self.case.save()
+        self.assertEqual(len(self.search("iphone case").data["results"]), 0)
+
+        self.charger.delete()
+        self.assertEqual(len(self.search("charger").data["results"]), 0)
+
+    def test_search_pagination(self):
+        response = self.search("iphone", page_size=1)
+
+        self.assertEqual(len(response.data["results"]), 1)
+        response = self.client.get(response.data["next"])
+        self.assertEqual(response.data["results"][0]["slug"], self.charger.slug)
+        self.assertIsNone(response.data["next"])
+
+    def test_search_page_limit(self):
+        url = reverse("products:search")
+        with mock.patch.object(ProductSearchView, "max_page", 1):
+            self.assertIsNone(self.search("iphone", page_size=1).data["next"])
+            response = self.client.get(url, {"q": "iphone", "page": 2})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProductFacetTests(ProductFactoryMixin, APITestCase):
+    def setUp(self):
+        cache.clear()
+        super().setUp()
+        self.phone = self.category
+        self.case = Category.objects.create(title="case", parent=self.phone)
+        self.book = Category.objects.create(title="book")
+        self.iphone = self.create_product("iphone", brand="apple", price=900)
+        self.cover = self.create_product(
+            "cover", brand="apple", category=self.case, price=20
+        )
+        self.pixel = self.create_product("pixel", brand="google", price=700, quantity=0)
+        self.novel = self.create_product("novel", category=self.book)
+        self.create_product("draft", brand="apple", category=self.book, status="draft")
+
+    def get_slugs(self, **params):
+        response = self.client.get(reverse("products:list"), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return sorted(product["slug"] for product in response.data)
+
+    def get_facets(self, **params):
+        response = self.client.get(reverse("products:list"), {"facets": 1, **params})
+        return {
+            facet: {bucket["value"]: bucket["count"] for bucket in buckets}
+            for facet, buckets in response.data["facets"].items()
+        }
+
+    def test_filters(self):
+        self.assertEqual(self.get_slugs(brand="apple"), ["cover", "iphone"])
+        self.assertEqual(
+            self.get_slugs(category=self.phone.id), ["cover", "iphone", "pixel"]
+        )
+        self.assertEqual(self.get_slugs(status="out_of_stack"), ["pixel"])
+        self.assertEqual(
+            self.get_slugs(min_price=20, max_price=700), ["cover", "pixel"]
+        )
+
+        response = self.client.get(reverse("products:list"), {"min_price": "cheap"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_effective_price_filters_and_ordering(self):
+        self.iphone.discount_price = 650
+        self.iphone.save()
+
+        self.assertEqual(
+            self.get_slugs(min_price=20, max_price=700), ["cover", "iphone", "pixel"]
+        )
+
+        for ordering, expected in [
+            ("effective_price", ["novel", "cover", "iphone", "pixel"]),
+            ("-effective_price", ["pixel", "iphone", "cover", "novel"]),
+        ]:
+            slugs = []
+            url = reverse("products:list") + f"?ordering={ordering}&page_size=3"
+            while url:
+                response = self.client.get(url)
+                slugs += [product["slug"] for product in response.data["results"]]
+                url = response.data["next"]
+            self.assertEqual(slugs, expected)
+
+        response = self.client.get(reverse("products:list"), {"ordering": "price"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_facets(self):
+        facets = self.get_facets()
+
+        self.assertEqual(facets["brand"], {"apple": 2, "google": 1})
+        self.assertEqual(
+            facets["category"], {self.phone.id: 3, self.case.id: 1, self.book.id: 1}
+        )
+        self.assertEqual(facets["status"], {"published": 3, "out_of_stack": 1})
+        self.assertEqual(self.get_facets(brand="apple")["status"], {"published": 2})
+
+    def test_facet_counts_are_adjusted_incrementally(self):
+        self.get_facets()
+
+        self.novel.brand = "google"
+        self.novel.save()
+        self.create_product("tablet", brand="apple", price=500)
+        Product.objects.get(pk=self.pixel.pk).delete()
+
+        with CaptureQueriesContext(connection) as context:
+            facets = self.get_facets()
+        self.assertFalse(any("GROUP BY" in query["sql"] for query in context))
+        self.assertEqual(facets["brand"], {"apple": 3, "google": 1})
+        self.assertEqual(facets["status"], {"published": 4})
+
+    def test_loaded_products_only_track_facet_and_price_fields(self):
+        product = Product.objects.get(pk=self.novel.pk)
+        product.brand = "google"
+        product.save()
+
+        for instance in [product, Product.objects.get(pk=self.novel.pk)]:
+            self.assertEqual(instance._loaded_values["brand"], "google")
+            self.assertIn("price", instance._loaded_values)
+            self.assertNotIn("description", instance._loaded_values)
+
+
+class ProductImportTests(ProductFactoryMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.existing = self.create_product("charger", description="usb")
+        self.client.force_authenticate(self.seller)
+
+    def upload(self, name, content, **data):
+        if isinstance(content, str):
+            content = content.encode()
+        file = SimpleUploadedFile(name, content)
+        return self.client.post(
+            reverse("products:seller_import"), {"file": file, **data}
+        )
+
+    def test_csv_import(self):
+        content = (
+            "title,price,quantity,description,status,category,slug\n"
+            f"charger,5,3,usb,published,{self.category.id},\n"
+            f"charger,5,0,usb,published,{self.category.id},\n"
+            f"case,abc,3,cover,published,{self.category.id},\n"
+            f"case,5,3,cover,published,{self.category.id},charger\n"
+            "case,5,3,cover,published,0,\n"
+            f"stand,7.5,2,desk,draft,{self.category.id},my-stand\n"
+        )
+
+        # 5 of them lease an id block, as setUp's lease never commits
+        with self.assertNumQueries(14):
+            response = self.upload("products.csv", content)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["created"], 3)
+        self.assertEqual(
+            {error["row"]: list(error["errors"]) for error in response.data["errors"]},
+            {3: ["price"], 4: ["slug"], 5: ["category"]},
+        )
+
+        products = Product.objects.exclude(pk=self.existing.pk).order_by("title")
+        self.assertEqual(len({product.slug for product in products}), 3)
+        self.assertEqual(products.get(slug="my-stand").status, "draft")
+        published, out_of_stock = products.filter(title="charger").order_by("quantity")[
+            ::-1
+        ]
+        self.assertIsNotNone(published.published_at)
+        self.assertEqual(out_of_stock.status, "out_of_stack")
+        self.assertEqual(len(get_search_backend().search("charger", 0, 10)), 3)
+
+    @override_settings(STOCK_DIGEST=True, LOW_STOCK_THRESHOLD=2)
+    def test_import_flags_low_stock(self):
+        content = (
+            "title,price,quantity,description,status,category\n"
+            f"case,5,1,cover,published,{self.category.id}\n"
+            f"stand,5,0,desk,published,{self.category.id}\n"
+            f"charger,5,9,usb,published,{self.category.id}\n"
+        )
+
+        response = self.upload("products.csv", content)
+
+        self.assertEqual(response.data["created"], 3)
+        flagged = Product.objects.filter(stock_alert_at__isnull=False)
+        self.assertEqual(
+            sorted(flagged.values_list("title", "status")),
+            [("case", "published"), ("stand", "out_of_stack")],
+        )
+
+    def test_import_allocates_one_id_per_row_without_one(self):
+        content = (
+            "id,title,price,quantity,description,category\n"
+            f"1000000042,case,5,1,cover,{self.category.id}\n"
+            f",stand,5,1,desk,{self.category.id}\n"
+            f",charger,5,1,usb,{self.category.id}\n"
+        )
+        allocator = mock.Mock()
+        allocator.allocate.return_value = ["1000000042", "1000000043", "1000000044"]
+
+        with mock.patch("products.importer.get_id_allocator", return_value=allocator):
+            response = self.upload("products.csv", content)
+
+        self.assertEqual(response.data["created"], 3)
+        allocator.allocate.assert_called_once_with(3)
+        self.assertEqual(
+            sorted(
+                Product.objects.filter(owner=self.seller).values_list("id", flat=True)
+            ),
+            [self.existing.id, "1000000042", "1000000043", "1000000044"],
+        )
+
+    def test_ndjson_import(self):
+        rows = [
+            {"title": "case", "price": "5", "quantity": 1, "description": "d"},
+            {"title": "isbn", "price": "5", "quantity": 1, "description": "d"},
+        ]
+        rows[0]["category"] = rows[1]["category"] = self.category.id
+        rows[1]["id_type"] = "isbn"
+        content = "\n".join(json.dumps(row) for row in rows) + "\nnot json\n"
+
+        response = self.upload("products.txt", content, format="ndjson")
+
+        self.assertEqual(response.data["created"], 1)
+        self.assertEqual([error["row"] for error in response.data["errors"]], [2, 3])
+
+    def test_unreadable_files(self):
+        header = "title,price,quantity,description,category\n"
+        row = f"case,5,3,cover,{self.category.id}\n"
+
+        response = self.upload("products.csv", (header + row).encode("utf-16"))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            response.data["errors"],
+            [{"row": 1, "errors": {"file": ["The file isn't UTF-8 encoded."]}}],
+        )
+
+        response = self.upload("products.csv", header + "x" * 200_000 + "\n")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(list(response.data["errors"][0]["errors"]), ["file"])
+
+    def test_unknown_format(self):
+        response = self.upload("products.xml", "<products/>")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProductBulkUpdateTests(ProductFactoryMixin, QueryBudgetMixin, APITestCase):
+    url = reverse("products:seller_bulk_update")
+
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_seller("other")
+        self.case = self.create_product("case")
+        self.charger = self.create_product("charger")
+        self.stand = self.create_product("stand", owner=self.other)
+        self.client.force_authenticate(self.seller)
+
+    def test_bulk_update(self):
+        mail.outbox = []
+        updates = [
+            {"id": self.case.id, "price": "8.50", "discount_price": None},
+            {"slug": self.charger.slug, "quantity": 0},
+        ]
+
+        response = self.client.patch(self.url, updates, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["out_of_stack"], [self.charger.slug])
+        self.case.refresh_from_db()
+        self.charger.refresh_from_db()
+        self.assertEqual(self.case.price, Decimal("8.50"))
+        self.assertEqual(self.case.quantity, 5)
+        self.assertEqual(self.charger.status, "out_of_stack")
+        self.assertIsNone(self.charger.published_at)
+        self.assertEqual(send_outbox(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("charger", mail.outbox[0].body)
+
+        updates = [{"slug": self.charger.slug, "quantity": 3}]
+        response = self.client.patch(self.url, updates, format="json")
+        self.charger.refresh_from_db()
+        self.assertEqual(self.charger.status, "published")
+        self.assertIsNotNone(self.charger.published_at)
+
+    def test_bulk_update_is_scoped_to_owner(self):
+        updates = [
+            {"id": self.case.id, "price": "1"},
+            {"id": self.stand.id, "price": "1"},
+            {"slug": "missing", "price": "x"},
+        ]
+
+        response = self.client.patch(self.url, updates, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(list(response.data[2]), ["price"])
+
+        response = self.client.patch(self.url, updates[:2], format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], {})
+        self.assertIn("non_field_errors", response.data[1])
+        self.case.refresh_from_db()
+        self.assertEqual(self.case.price, 10)
+
+    def test_bulk_update_id_and_slug_must_match(self):
+        updates = [
+            {"id": self.case.id, "slug": self.case.slug, "price": "1"},
+            {"id": self.case.id, "slug": self.charger.slug, "price": "2"},
+            {"id": "missing", "slug": self.charger.slug, "price": "3"},
+        ]
+
+        response = self.client.patch(self.url, updates, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], {})
+        self.assertIn("non_field_errors", response.data[1])
+        self.assertIn("non_field_errors", response.data[2])
+        self.charger.refresh_from_db()
+        self.assertEqual(self.charger.price, 10)
+
+    def test_bulk_update_query_budget(self):
+        def request():
+            updates = [
+                {"id": product.id, "quantity": 3}
+                for product in Product.objects.filter(owner=self.seller)
+            ]
+            self.client.patch(self.url, updates, format="json")
+
+        self.assertQueriesDoNotScale(
+            request,
+            lambda: [self.create_product("new") for _ in range(5)],
+        )
+
+
+@override_settings(STOCK_DIGEST=True, LOW_STOCK_THRESHOLD=2)
+class StockDigestTests(ProductFactoryMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_seller("other")
+        self.case = self.create_product("case")
+        self.charger = self.create_product("charger")
+        self.stand = self.create_product("stand", owner=self.other)
+
+    def test_one_digest_per_seller(self):
+        for product, quantity in [(self.case, 0), (self.charger, 2), (self.stand, 0)]:
+            product.quantity = quantity
+            product.save()
+        self.client.force_authenticate(self.seller)
+        self.client.patch(
+            reverse("products:seller_bulk_update"),
+            [{"slug": "case", "quantity": 0}],
+            format="json",
+        )
+        self.assertFalse(OutboxEmail.objects.exists())
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(send_stock_digests(), 2)
+        selects = [
+            query["sql"]
+            for query in context
+            if query["sql"].startswith("SELECT")
+            and '"products_product"' in query["sql"]
+        ]
+        self.assertEqual(len(selects), 1)
+
+        emails = {email.to[0]: email.body for email in OutboxEmail.objects.all()}
+        self.assertIn(
+            "- case: out of stack\n- charger: 2 left", emails["seller@email.com"]
+        )
+        self.assertIn("- stand: out of stack", emails["other@email.com"])
+        self.assertFalse(Product.objects.filter(stock_alert_at__isnull=False).exists())
+        self.assertEqual(send_stock_digests(), 0)
+
+    def test_restocked_products_are_left_out(self):
+        self.case.quantity = 0
+        self.case.save()
+        self.case.quantity = 10
+        self.case.save()
+
+        self.assertEqual(send_stock_digests(), 0)
+        self.assertFalse(OutboxEmail.objects.exists())
+
+
+class SingleFlightTests(TestCase):
+    def test_concurrent_calls_share_one_result(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        calls = []
+        results = []
+
+        def build():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return "payload"
+
+        def request():
+            results.append(single_flight.do("key", build))
+
+        leader = threading.Thread(target=request)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=request) for _ in range(10)]
+        for thread in followers:
+            thread.start()
+        for thread in [leader, *followers]:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["payload"] * 11)
+        self.assertEqual(single_flight.do("key", lambda: "next"), "next")
+
+    def test_errors_are_shared(self):
+        single_flight = SingleFlight()
+
+        def build():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            single_flight.do("key", build)
+        self.assertEqual(single_flight.calls, {})
+
+
+@skipUnless(connection.vendor == "sqlite", "plans are checked on SQLite")
+class SharedCacheCheckTests(TestCase):
+    def test_process_local_cache_warns_outside_debug(self):
+        redis = "django.core.cache.backends.redis.RedisCache"
+
+        with override_settings(DEBUG=False):
+            self.assertEqual(
+                [error.id for error in check_shared_cache(None)], ["products.W001"]
+            )
+        with override_settings(DEBUG=True):
+            self.assertEqual(check_shared_cache(None), [])
+        with override_settings(DEBUG=False, CACHES={"default": {"BACKEND": redis}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class CatalogIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(
+            "seller", email="seller@email.com", password="1234@#$%", role="seller"
+        )
+        categories = [
+            Category.objects.create(title=f"c{number}") for number in range(20)
+        ]
+        now = timezone.now()
+        Product.objects.bulk_create(
+            Product(
+                id=str(1_000_000_000 + number),
+                slug=f"product-{number}",
+                owner=cls.seller,
+                category=categories[number % 20],
+                title="product",
+                price=10,
+                quantity=5,
+                description="description",
+                status="draft" if number % 10 == 0 else "published",
+                published_at=None if number % 10 == 0 else now,
+            )
+            for number in range(2000)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def assertUsesIndex(self, queryset, index):
+        plan = queryset.explain()
+        self.assertIn(f"USING INDEX {index}", plan)
+        if queryset.ordered:
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_catalog_page(self):
+        queryset = Product.published_objects.filter(published_at__isnull=False)
+
+        self.assertUsesIndex(
+            queryset.order_by("-published_at", "-id")[:21], "product_published_idx"
+        )
+
+    def test_category_filter(self):
+        category = Category.objects.first()
+
+        self.assertUsesIndex(
+            Product.published_objects.filter(category=category),
+            "product_category_idx",
+        )
+
+    def test_seller_products(self):
+        self.assertUsesIndex(
+            Product.objects.filter(owner=self.seller).order_by("-created_at"),
+            "product_owner_idx",
+        )
+
+    def test_status_filter(self):
+        self.assertUsesIndex(
+            Product.objects.filter(status="draft").order_by("published_at"),
+            "product_status_idx",
+        )
+
+
+class IDAllocatorTests(TestCase):
+    def setUp(self):
+        seller = User.objects.create_user(
+            "seller", email="seller@email.com", password="1234@#$%", role="seller"
+        )
+        self.legacy = Product.objects.create(
+            id="1000000003",
+            owner=seller,
+            category=Category.objects.create(title="phone"),
+            title="legacy",
+            price=10,
+            quantity=5,
+            description="random id from before the sequence",
+        )
+
+    def test_workers_never_overlap(self):
+        # allocators sharing a database, like worker processes on many nodes
+        workers = [BlockIDAllocator(block_size=7) for _ in range(4)]
+        rng = random.Random(0)
+        ids = []
+
+        for _ in range(400):
+            ids += rng.choice(workers).allocate(rng.randint(1, 10))
+
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertNotIn(self.legacy.id, ids)
+        self.assertTrue(all(len(id) == 10 and id.isdigit() for id in ids))
+
+    def test_rolled_back_lease_is_dropped(self):
+        first = BlockIDAllocator(block_size=10)
+        second = BlockIDAllocator(block_size=10)
+
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                first.allocate()
+                raise ValueError
+        ids = second.allocate(5) + first.allocate(5)
+
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_leftover_ids_are_pooled_on_commit(self):
+        allocator = BlockIDAllocator(block_size=10)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            first = allocator.allocate(3)
+            self.assertEqual(allocator.block, [])
+        for callback in callbacks:
+            callback()
+        pooled = list(allocator.block)
+        second = allocator.allocate(3)
+
+        self.assertTrue(pooled)
+        self.assertFalse(set(first) & set(pooled))
+        self.assertEqual(second, pooled[:3])
+
+
+class IDAllocatorThreadTests(TransactionTestCase):
+    def test_threads_never_overlap(self):
+        allocator = BlockIDAllocator(block_size=50)
+        ids = []
+
+        def allocate():
+            for _ in range(100):
+                while True:
+                    try:
+                        ids.extend(allocator.allocate(3))
+                        break
+                    except OperationalError:
+                        # the in-memory test database raises instead of
+                        # waiting for a lock; the failed lease wrote nothing
+                        time.sleep(0.001)
+            connection.close()
+
+        threads = [threading.Thread(target=allocate) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(ids), 2400)
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_lease_outlives_the_callers_transaction(self):
+        allocator = BlockIDAllocator(block_size=10)
+
+        # SQLite leases in the caller's transaction, other databases don't
+        with mock.patch.object(connection, "vendor", "postgresql"):
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    ids = allocator.allocate(3)
+                    raise ValueError
+
+        self.assertEqual(IDSequence.objects.get().next_value, 1_000_000_010)
+        self.assertEqual(len(allocator.block), 7)
+        self.assertFalse(set(ids) & set(allocator.block))
+
+
+class CartThreadTests(ProductFactoryMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.buyer = User.objects.create_user(
+            "buyer", email="buyer@email.com", password="1234@#$%"
+        )
+        self.product = self.create_product("case")
+
+    def add_concurrently(self, add):
+        def run():
+            for _ in range(5):
+                while True:
+                    try:
+                        add(self.buyer, self.product.slug, 1)
+                        break
+                    except OperationalError:
+                        # the in-memory test database raises instead of waiting
+                        # for a lock; the failed add wrote nothing, so retry it
+                        time.sleep(0.001)
+            connection.close()
+
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        line = Cart.objects.get(user=self.buyer, product=self.product)
+        self.assertEqual(line.quantity, 40)
+
+    def test_concurrent_upserts_never_lose_an_add(self):
+        self.add_concurrently(Cart.objects.add)
+
+    def test_concurrent_updates_never_lose_an_add(self):
+        self.add_concurrently(Cart.objects.add_with_update)
+
+    def test_update_fallback(self):
+        for quantity in [2, 3]:
+            line = Cart.objects.add_with_update(self.buyer, self.product.slug, quantity)
+        self.assertEqual(line[1:], (self.product.id, 5))
+        self.assertIsNone(Cart.objects.add_with_update(self.buyer, "missing", 1))
+
+    def test_add_falls_back_without_returning(self):
+        # SQLite before 3.35 has ON CONFLICT but no RETURNING
+        features = type(connection.features)
+        with mock.patch.object(features, "can_return_rows_from_bulk_insert", False):
+            with mock.patch.object(CartQuerySet, "add_with_update") as fallback:
+                Cart.objects.add(self.buyer, self.product.slug, 2)
+        fallback.assert_called_once_with(self.buyer, self.product.slug, 2)
+
+
+class CheckoutTests(ProductFactoryMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.buyer = User.objects.create_user(
+            "buyer", email="buyer@email.com", password="1234@#$%"
+        )
+        self.case = self.create_product("case", quantity=2, discount_price=8)
+        self.charger = self.create_product("charger", price=20)
+        Cart.objects.create(user=self.buyer, product=self.case, quantity=2)
+        Cart.objects.create(user=self.buyer, product=self.charger, quantity=1)
+        self.client.force_authenticate(self.buyer)
+
+    def test_checkout(self):
+        OutboxEmail.objects.all().delete()
+
+        response = self.client.post(reverse("products:checkout"))
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["subtotal"], "40.00")
+        self.assertEqual(response.data["discount"], "4.00")
+        self.assertEqual(response.data["total"], "36.00")
+        self.assertEqual(
+            [(item["product"], item["quantity"]) for item in response.data["items"]],
+            [("case", 2), ("charger", 1)],
+        )
+        self.case.refresh_from_db()
+        self.charger.refresh_from_db()
+        self.assertEqual((self.case.quantity, self.case.status), (0, "out_of_stack"))
+        self.assertEqual(self.charger.quantity, 4)
+        self.assertFalse(Cart.objects.filter(user=self.buyer).exists())
+        self.assertIn("case", OutboxEmail.objects.get().body)
+
+    def test_lines_added_during_checkout_stay_in_cart(self):
+        stand = self.create_product("stand", price=5, quantity=3)
+
+        def add_line(user, lines):
+            Cart.objects.create(user=user, product=stand, quantity=1)
+            return create_order(user, lines)
+
+        with mock.patch("products.checkout.create_order", add_line):
+            order = checkout(self.buyer)
+
+        self.assertEqual(order.items.count(), 2)
+        self.assertEqual(
+            list(
+                Cart.objects.filter(user=self.buyer).values_list("product", "quantity")
+            ),
+            [(stand.pk, 1)],
+        )
+
+    def test_unavailable_lines_roll_back(self):
+        Product.objects.filter(pk=self.case.pk).update(quantity=1)
+
+        response = self.client.post(reverse("products:checkout"))
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {"unavailable": ["case"]})
+        self.charger.refresh_from_db()
+        self.assertEqual(self.charger.quantity, 5)
+        self.assertEqual(Cart.objects.filter(user=self.buyer).count(), 2)
+        self.assertFalse(Order.objects.exists())
+
+    def test_profile_totals(self):
+        self.client.post(reverse("products:checkout"))
+        order = Order.objects.get()
+        buyer = BuyerProfile.objects.get(user=self.buyer)
+        seller = SellerProfie.objects.get(user=self.seller)
+        self.assertEqual((buyer.total_order, buyer.total_purchase), (1, 36))
+        self.assertEqual((seller.revenue, seller.income), (36, 36))
+
+        self.assertTrue(refund(order))
+        self.assertFalse(refund(order))
+
+        buyer.refresh_from_db()
+        seller.refresh_from_db()
+        self.assertEqual((buyer.total_order, buyer.total_purchase), (0, 0))
+        self.assertEqual((seller.revenue, seller.income), (36, 0))
+
+    def test_reconcile_profile_totals(self):
+        self.client.post(reverse("products:checkout"))
+        BuyerProfile.objects.update(total_order=5)
+        SellerProfie.objects.update(revenue=None)
+        out = io.StringIO()
+
+        call_command("reconcile_profile_totals", "--dry-run", stdout=out)
+        self.assertIn("stored 5, expected 1", out.getvalue())
+        self.assertIn("revenue: stored 0, expected 36", out.getvalue())
+        self.assertEqual(BuyerProfile.objects.get(user=self.buyer).total_order, 5)
+
+        call_command("reconcile_profile_totals", "--batch-size", "1", stdout=out)
+        self.assertEqual(BuyerProfile.objects.get(user=self.buyer).total_order, 1)
+        self.assertEqual(SellerProfie.objects.get(user=self.seller).revenue, 36)
+        self.assertEqual(list(reconcile_buyers()), [])
+        self.assertEqual(list(reconcile_sellers()), [])
+
+    def test_empty_cart(self):
+        Cart.objects.all().delete()
+
+        response = self.client.post(reverse("products:checkout"))
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("cart", response.data)
+
+    def test_empty_lines_are_not_ordered(self):
+        Cart.objects.filter(product=self.case).delete()
+        Cart.objects.filter(product=self.charger).update(quantity=0)
+
+        response = self.client.post(reverse("products:checkout"))
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Order.objects.exists())
+        url = reverse("products:cart", kwargs={"slug": self.case.slug})
+        response = self.client.post(url, {"quantity": 0}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CheckoutThreadTests(ProductFactoryMixin, TransactionTestCase):
+    def test_concurrent_checkouts_never_oversell(self):
+        product = self.create_product("case", quantity=10)
+        buyers = []
+        for number in range(25):
+            buyer = User.objects.create_user(
+                f"buyer{number}", email=f"buyer{number}@email.com", password="pass"
+            )
+            Cart.objects.create(user=buyer, product=product, quantity=1)
+            buyers.append(buyer)
+        results = []
+
+        def run(buyer):
+            while True:
+                try:
+                    checkout(buyer)
+                    results.append(True)
+                    break
+                except CheckoutError:
+                    results.append(False)
+                    break
+                except OperationalError:
+                    # the in-memory test database raises instead of waiting
+                    # for a lock, and the whole checkout rolled back
+                    time.sleep(0.001)
+            connection.close()
+
+        threads = [threading.Thread(target=run, args=[buyer]) for buyer in buyers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        self.assertEqual(results.count(True), 10)
+        self.assertEqual(results.count(False), 15)
+        self.assertEqual((product.quantity, product.status), (0, "out_of_stack"))
+        self.assertEqual(Order.objects.count(), 10)
+        self.assertEqual(Cart.objects.count(), 15)
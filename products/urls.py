@@ -4,10 +4,25 @@ from .views import *
 
 app_name = "products"
 urlpatterns = [
+    path("cart/", CartListView.as_view(), name="cart_list"),
+    path("cart/batch/", CartBatchView.as_view(), name="cart_batch"),
+    path("cart/summary/", CartSummaryView.as_view(), name="cart_summary"),
     path("cart/<str:slug>/", CartView.as_view(), name="cart"),
+    path("checkout/", CheckoutView.as_view(), name="checkout"),
     path("category/", CategoriesView.as_view(), name="category"),
     path("product-id-type/", ProductIDTypeView.as_view(), name="id_type"),
+    path("search/", ProductSearchView.as_view(), name="search"),
     path("products/my/", SellerProductsView.as_view(), name="seller_list"),
+    path(
+        "products/my/bulk-update/",
+        SellerProductBulkUpdateView.as_view(),
+        name="seller_bulk_update",
+    ),
+    path(
+        "products/my/import/",
+        SellerProductImportView.as_view(),
+        name="seller_import",
+    ),
     path("products/my/<str:slug>/", SellerProductView.as_view(), name="seller_detail"),
     path("", ProductsView.as_view(), name="list"),
     path("<str:slug>/", ProductView.as_view(), name="detail"),
@@ -1,33 +1,76 @@
-import random
+from itertools import groupby
+from operator import attrgetter
 
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.core.mail import EmailMultiAlternatives
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.text import slugify
 
-domain = Site.objects.get_current().domain
-
-
-def generate_random_number(cls):
-    random_number = random.randint(1_000_000_000, 9_999_999_999)
-
-    if cls.objects.filter(id=random_number).exists():
-        return generate_random_number(cls)
-
-    return random_number
+from outbox.utils import queue_email
 
+domain = Site.objects.get_current().domain
 
-def generate_title_to_slug(cls, title, new_slug=None):
-    if new_slug is not None:
-        slug = new_slug
-    else:
-        slug = slugify(title)
-
-    if cls.objects.filter(slug=slug).exists():
-        new_slug = slugify(title) + "-" + str(random.randint(1_000_000, 9_999_999))
-        return generate_title_to_slug(cls, title, new_slug=new_slug)
 
-    return slug
+def get_slug_base(cls, title):
+    # leave room for a "-N" suffix within the column
+    max_length = cls._meta.get_field("slug").max_length
+    return slugify(title)[: max_length - 8].strip("-") or "product"
+
+
+def get_slug_variants(base):
+    if connection.vendor == "postgresql":
+        # served by the varchar_pattern_ops index Django adds to slug
+        return Q(slug=base) | Q(slug__startswith=f"{base}-")
+    # "." sorts right after "-", so this is a range scan of the slug index
+    return Q(slug=base) | Q(slug__gt=f"{base}-", slug__lt=f"{base}.")
+
+
+def generate_title_to_slug(cls, title):
+    return generate_titles_to_slugs(cls, [title])[0]
+
+
+def generate_titles_to_slugs(cls, titles, exclude=(), batch_size=100):
+    """
+    A free slug for each of ``titles``: the slugified title, or else that
+    base with the lowest free ``-N`` suffix. The taken variants of up to
+    ``batch_size`` bases are found with one indexed query; ``exclude``
+    holds slugs to treat as taken too.
+    """
+    bases = [get_slug_base(cls, title) for title in titles]
+    taken = {base: set() for base in bases}
+
+    def mark_taken(slug):
+        if slug in taken:
+            taken[slug].add(0)
+        prefix, _, suffix = slug.rpartition("-")
+        if prefix in taken and suffix.isdigit():
+            taken[prefix].add(int(suffix))
+
+    unique_bases = list(taken)
+    for start in range(0, len(unique_bases), batch_size):
+        condition = Q()
+        for base in unique_bases[start : start + batch_size]:
+            condition |= get_slug_variants(base)
+        for slug in cls.objects.filter(condition).values_list("slug", flat=True):
+            mark_taken(slug)
+    for slug in exclude:
+        if slug:
+            mark_taken(slug)
+
+    slugs = []
+    next_suffix = {}
+    for base in bases:
+        suffix = next_suffix.get(base, 0)
+        while suffix in taken[base]:
+            suffix += 1
+        next_suffix[base] = suffix + 1
+        slug = f"{base}-{suffix}" if suffix else base
+        # a suffixed slug can be another title's base, and vice versa
+        mark_taken(slug)
+        slugs.append(slug)
+    return slugs
 
 
 def send_mail_to_product_owner_for_out_of_stack(instance):
@@ -39,10 +82,73 @@ def send_mail_to_product_owner_for_out_of_stack(instance):
         + "So please update product quantity as soon as possible"
     )
     from_email = settings.DEFAULT_FROM_EMAIL
-    msg = EmailMultiAlternatives(
-        subject, body, f"{domain} <{from_email}>", [owner.email]
+    queue_email(subject, body, f"{domain} <{from_email}>", [owner.email])
+
+
+def send_mail_to_product_owner_for_out_of_stack_products(owner, titles):
+    subject = "Out of Stack"
+    products = "\n".join(f"- {title}" for title in titles)
+    body = (
+        f"Hi {owner.get_full_name()},"
+        + f"These products of yours are out of stack:\n{products}\n"
+        + "So please update product quantity as soon as possible"
+    )
+    from_email = settings.DEFAULT_FROM_EMAIL
+    queue_email(subject, body, f"{domain} <{from_email}>", [owner.email])
+
+
+def send_stock_digests():
+    """
+    Queue one email per seller listing their products flagged for a stock
+    alert that are still out of stack or low on stock, read with a single
+    query ordered by seller, and clear the flags. Returns how many
+    emails were queued.
+    """
+    from .managers import PUBLISHED_STATUSES
+    from .models import Product
+
+    now = timezone.now()
+    with transaction.atomic():
+        rows = (
+            Product.objects.filter(
+                stock_alert_at__lte=now,
+                status__in=PUBLISHED_STATUSES,
+                quantity__lte=settings.LOW_STOCK_THRESHOLD,
+            )
+            .select_related("owner")
+            .only(
+                "title",
+                "quantity",
+                "owner__email",
+                "owner__first_name",
+                "owner__last_name",
+            )
+            .order_by("owner_id", "quantity", "title")
+        )
+        digests = 0
+        for _, products in groupby(rows, key=attrgetter("owner_id")):
+            products = list(products)
+            send_stock_digest(products[0].owner, products)
+            digests += 1
+        # restocked products are cleared without an email
+        Product.objects.filter(stock_alert_at__lte=now).update(stock_alert_at=None)
+    return digests
+
+
+def send_stock_digest(owner, products):
+    subject = "Stock Alert"
+    lines = "\n".join(
+        f"- {product.title}: "
+        + (f"{product.quantity} left" if product.quantity else "out of stack")
+        for product in products
     )
-    msg.send(fail_silently=False)
+    body = (
+        f"Hi {owner.get_full_name()},"
+        + f"These products of yours are out of stack or running low:\n{lines}\n"
+        + "So please update product quantity as soon as possible"
+    )
+    from_email = settings.DEFAULT_FROM_EMAIL
+    queue_email(subject, body, f"{domain} <{from_email}>", [owner.email])
 
 
 def thumbnail_directory_path(instance, filename):
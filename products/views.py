@@ -1,35 +1,237 @@
+import hashlib
 import json
+from datetime import datetime, timezone
 
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from django.http import Http404
 from django.shortcuts import get_object_or_404
-from rest_framework import status
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from rest_framework import exceptions, status
 from rest_framework.generics import ListAPIView, RetrieveAPIView
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import AllowAny
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.views import APIView, Response
 
 from utils.permissions import IsSeller
-
+from utils.streaming import StreamingJSONListResponse
+
+from .cache import (
+    CATALOG_VERSION_KEY,
+    CATEGORY_VERSION_KEY,
+    get_category_tree,
+    get_modified,
+    get_product_payload,
+    get_product_version_key,
+    get_version,
+)
+from .checkout import CheckoutError, checkout
+from .filters import ProductFilterBackend, get_facets
+from .importer import FORMATS, import_products, read_rows
 from .models import *
+from .pagination import KeysetPagination
+from .search import get_search_backend
 from .serializers import *
+from .signals import products_bulk_changed
+from .utils import send_mail_to_product_owner_for_out_of_stack_products
+
+# Validators for conditional GET, read from the cache only so a 304 is
+# answered without touching the database or the serializers.
+
+
+def to_datetime(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+def category_etag(request, *args, **kwargs):
+    return f"category-{get_version(CATEGORY_VERSION_KEY)}"
+
+
+def category_last_modified(request, *args, **kwargs):
+    return to_datetime(get_modified(CATEGORY_VERSION_KEY))
+
+
+def catalog_etag(request, *args, **kwargs):
+    query = hashlib.md5(request.META.get("QUERY_STRING", "").encode()).hexdigest()
+    return f"catalog-{get_version(CATALOG_VERSION_KEY)}-{query}"
+
+
+def catalog_last_modified(request, *args, **kwargs):
+    return to_datetime(get_modified(CATALOG_VERSION_KEY))
+
+
+def get_fieldset(request):
+    """
+    Digest of the sparse fieldset parameters, so every fieldset of a
+    product gets its own ETag and cached payload.
+    """
+    fieldset = [request.GET.get(param, "") for param in ["fields", "include"]]
+    return hashlib.md5("&".join(fieldset).encode()).hexdigest()
+
+
+def product_etag(request, slug, *args, **kwargs):
+    version = get_version(get_product_version_key(slug))
+    return (
+        f"product-{version}-{get_version(CATEGORY_VERSION_KEY)}"
+        f"-{get_fieldset(request)}"
+    )
+
+
+def product_last_modified(request, slug, *args, **kwargs):
+    modified = get_modified(get_product_version_key(slug))
+    return to_datetime(max(modified, get_modified(CATEGORY_VERSION_KEY)))
+
+
+class SparseFieldsetQuerysetMixin:
+    """
+    Load only the columns the selected sparse fieldset renders.
+    """
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        ordering = [field.lstrip("-") for field in getattr(self, "ordering", ())]
+        return queryset.only(*self.get_serializer().get_only_fields(), *ordering)
 
+
+class ValuesQuerysetMixin:
+    """
+    List ``.values()`` rows instead of model instances, which the list
+    serializer renders without instantiating models.
+    """
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        ordering = [field.lstrip("-") for field in getattr(self, "ordering", ())]
+        return self.get_serializer(many=True).values(queryset, *ordering)
+
+
+@method_decorator(
+    condition(etag_func=category_etag, last_modified_func=category_last_modified),
+    name="get",
+)
 class CategoriesView(ListAPIView):
+    # public catalog endpoints skip authentication, which would query the user
+    authentication_classes = []
     permission_classes = [AllowAny]
     serializer_class = CategorySerializer
     queryset = Category.objects.viewable()
 
+    def list(self, request, *args, **kwargs):
+        return Response(get_category_tree(), status=status.HTTP_200_OK)
+
 
-class ProductsView(ListAPIView):
+@method_decorator(
+    condition(etag_func=catalog_etag, last_modified_func=catalog_last_modified),
+    name="get",
+)
+class ProductsView(ValuesQuerysetMixin, ListAPIView):
+    authentication_classes = []
+    permission_classes = [AllowAny]
+    serializer_class = ProductListSerializer
+    pagination_class = KeysetPagination
+    filter_backends = [ProductFilterBackend]
+    queryset = Product.published_objects.with_related()
+    # ?ordering= choices; every one ends with the unique id for the cursors
+    orderings = {
+        "-published_at": ("-published_at", "-id"),
+        "effective_price": ("effective_price", "id"),
+        "-effective_price": ("-effective_price", "-id"),
+    }
+    default_ordering = "-published_at"
+
+    @property
+    def ordering(self):
+        ordering = self.request.query_params.get("ordering", self.default_ordering)
+        if ordering not in self.orderings:
+            raise exceptions.ValidationError(
+                {"ordering": f"Choose from {', '.join(self.orderings)}."}
+            )
+        return self.orderings[ordering]
+
+    def get_queryset(self):
+        return super().get_queryset().order_by(*self.ordering)
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+
+        if "facets" in request.query_params:
+            if not isinstance(response.data, dict):
+                response.data = {"results": response.data}
+            queryset = self.filter_queryset(self.get_queryset())
+            response.data["facets"] = get_facets(request, queryset)
+        return response
+
+
+@method_decorator(
+    condition(etag_func=product_etag, last_modified_func=product_last_modified),
+    name="get",
+)
+class ProductView(SparseFieldsetQuerysetMixin, RetrieveAPIView):
+    authentication_classes = []
     permission_classes = [AllowAny]
     serializer_class = ProductSerializer
-    queryset = Product.published_objects.all()
+    queryset = Product.published_objects.with_related()
+    lookup_field = "slug"
+
+    def retrieve(self, request, *args, **kwargs):
+        def build():
+            return dict(
+                super(ProductView, self).retrieve(request, *args, **kwargs).data
+            )
 
+        host = request.build_absolute_uri("/")
+        fieldset = get_fieldset(request)
+        data = get_product_payload(kwargs["slug"], host, build, fieldset)
+        return Response(data, status=status.HTTP_200_OK)
 
-class ProductView(RetrieveAPIView):
+
+class ProductSearchView(APIView):
     permission_classes = [AllowAny]
-    serializer_class = ProductSerializer
-    queryset = Product.published_objects.all()
-    lookup_field = "slug"
+    page_size = 20
+    max_page_size = 100
+    # each page ranks all the matches before it, so deep pages are refused
+    max_page = 50
+
+    def get_int_param(self, name, default, maximum=None):
+        try:
+            value = int(self.request.query_params[name])
+        except (KeyError, ValueError):
+            return default
+        if value <= 0:
+            return default
+        return min(value, maximum) if maximum else value
+
+    def get(self, request, format=None):
+        query = request.query_params.get("q", "")
+        page = self.get_int_param("page", 1)
+        page_size = self.get_int_param("page_size", self.page_size, self.max_page_size)
+        if page > self.max_page:
+            return Response(
+                {"page": [f"Only the first {self.max_page} pages can be searched."]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        ids = get_search_backend().search(query, (page - 1) * page_size, page_size + 1)
+        serializer = ProductListSerializer(many=True, context={"request": request})
+        products = (
+            Product.published_objects.with_related()
+            .only(*serializer.child.get_only_fields())
+            .in_bulk(ids[:page_size])
+        )
+        results = [products[id] for id in ids[:page_size] if id in products]
+
+        next_url = None
+        if len(ids) > page_size and page < self.max_page:
+            next_url = replace_query_param(
+                request.build_absolute_uri(), "page", page + 1
+            )
+        serializer.instance = results
+        return Response(
+            {"next": next_url, "results": serializer.data}, status=status.HTTP_200_OK
+        )
 
 
 class ProductIDTypeView(APIView):
@@ -44,10 +246,21 @@ class ProductIDTypeView(APIView):
 
 class SellerProductsView(APIView):
     permission_classes = [IsSeller]
+    stream_chunk_size = 2000
 
     def get(self, request, format=None):
-        my_products = Product.objects.filter(owner=self.request.user)
-        serializer = ProductSerializer(my_products, many=True)
+        serializer = ProductListSerializer(many=True, context={"request": request})
+        my_products = serializer.values(
+            Product.objects.filter(owner=self.request.user).order_by("-created_at")
+        )
+
+        # ?stream=1 renders big inventories incrementally, in constant memory
+        if request.query_params.get("stream") in ["1", "true"]:
+            return StreamingJSONListResponse(
+                serializer, my_products, self.stream_chunk_size
+            )
+
+        serializer.instance = my_products
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     def post(self, request, format=None):
@@ -61,12 +274,127 @@ class SellerProductsView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class SellerProductImportView(APIView):
+    """
+    Import products from an uploaded CSV or NDJSON ``file``, with the
+    ``ProductCreateSerializer`` fields as columns or keys.
+    """
+
+    permission_classes = [IsSeller]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, format=None):
+        file = request.FILES.get("file")
+        if file is None:
+            return Response(
+                {"file": ["No file was submitted."]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        format = request.data.get("format") or file.name.rsplit(".", 1)[-1].lower()
+        if format not in FORMATS:
+            return Response(
+                {"format": [f"Choose from {', '.join(FORMATS)}."]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        created, errors = import_products(request.user, read_rows(file, format))
+        return Response(
+            {"created": created, "errors": errors},
+            status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST,
+        )
+
+
+class SellerProductBulkUpdateView(APIView):
+    """
+    Update price, discount price and quantity of many of the seller's
+    products in one transaction, from a list of
+    ``{id|slug, price, discount_price, quantity}``.
+    """
+
+    permission_classes = [IsSeller]
+    max_items = 5000
+
+    def patch(self, request, format=None):
+        serializer = ProductBulkUpdateSerializer(
+            data=request.data, many=True, allow_empty=False, max_length=self.max_items
+        )
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        updates = serializer.validated_data
+        ids = [update["id"] for update in updates if "id" in update]
+        slugs = [update["slug"] for update in updates if "slug" in update]
+
+        with transaction.atomic():
+            products = (
+                Product.objects.filter(owner=request.user)
+                .filter(Q(id__in=ids) | Q(slug__in=slugs))
+                .select_for_update()
+            )
+            by_id = {product.id: product for product in products}
+            by_slug = {product.slug: product for product in by_id.values()}
+
+            errors = []
+            fields = set()
+            for update in updates:
+                found = [
+                    lookup.get(update[key])
+                    for key, lookup in [("id", by_id), ("slug", by_slug)]
+                    if key in update
+                ]
+                if None in found:
+                    errors.append({"non_field_errors": ["Product not found."]})
+                    continue
+                if found[0] is not found[-1]:
+                    errors.append(
+                        {"non_field_errors": ["id and slug are of different products."]}
+                    )
+                    continue
+                product = found[0]
+                errors.append({})
+                for field in ProductBulkUpdateSerializer.FIELDS:
+                    if field in update:
+                        setattr(product, field, update[field])
+                        fields.add(field)
+
+            if any(errors):
+                return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+            Product.objects.bulk_update(by_id.values(), fields, batch_size=500)
+            out_of_stock = []
+            if "quantity" in fields:
+                # stock driven status moves, one UPDATE per direction
+                Product.objects.filter(pk__in=by_id).mark_in_stock()
+                out_of_stock = Product.objects.filter(pk__in=by_id).mark_out_of_stock()
+            if settings.STOCK_DIGEST and "quantity" in fields:
+                Product.objects.filter(pk__in=by_id).flag_stock_alerts()
+            elif out_of_stock:
+                send_mail_to_product_owner_for_out_of_stack_products(
+                    request.user, [product["title"] for product in out_of_stock]
+                )
+
+        products_bulk_changed.send(
+            sender=Product, products=list(by_id.values()), created=False
+        )
+        return Response(
+            {
+                "updated": len(by_id),
+                "out_of_stack": [product["slug"] for product in out_of_stock],
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
 class SellerProductView(APIView):
     permission_classes = [IsSeller]
 
     def get(self, request, slug, format=None):
-        my_product = get_object_or_404(Product, slug=slug, owner=request.user)
-        serializer = ProductSerializer(my_product)
+        serializer = ProductSerializer(context={"request": request})
+        serializer.instance = get_object_or_404(
+            Product.objects.with_related().only(*serializer.get_only_fields()),
+            slug=slug,
+            owner=request.user,
+        )
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     def put(self, request, slug, format=None):
@@ -75,7 +403,7 @@ class SellerProductView(APIView):
 
         if serializer.is_valid():
             product = serializer.save()
-            serializer = ProductSerializer(product)
+            serializer = ProductSerializer(product, context={"request": request})
             return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -88,7 +416,7 @@ class SellerProductView(APIView):
 
         if serializer.is_valid():
             product = serializer.save()
-            serializer = ProductSerializer(product)
+            serializer = ProductSerializer(product, context={"request": request})
             return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -101,24 +429,109 @@ class SellerProductView(APIView):
         )
 
 
-class CartView(APIView):
+class CartListView(APIView):
     def get(self, request, format=None):
-        cart = Cart.objects.filter(user=request.user)
+        cart = Cart.objects.filter(user=request.user).select_related(
+            "user", "product__images"
+        )
         serializer = CartSerializer(cart, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+
+class CartView(APIView):
     def post(self, request, slug, format=None):
-        product = get_object_or_404(Product, slug=slug)
         serializer = CartSerializer(data=request.data)
 
         if serializer.is_valid():
-            if not Cart.objects.filter(user=request.user, product=product).exists():
-                serializer.save(product=product, user=request.user)
-            else:
-                cart = Cart.objects.get(user=request.user, product=product)
-                cart.quantity += serializer.data["quantity"]
-                cart.save()
-                serializer = CartSerializer(cart)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            # one statement that adds to the quantity of an existing line
+            line = Cart.objects.add(
+                request.user, slug, serializer.validated_data["quantity"]
+            )
+            if line is None:
+                raise Http404
+            id, product, quantity = line
+            return Response(
+                {"id": id, "product": product, "quantity": quantity},
+                status=status.HTTP_201_CREATED,
+            )
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+def get_cart_summary(request):
+    """
+    The user's cart as compact lines plus totals, computed in SQL with one
+    query for the lines and one aggregate.
+    """
+    cart = Cart.objects.filter(user=request.user)
+    serializer = CartLineSerializer(many=True, context={"request": request})
+    serializer.instance = serializer.values(cart.with_totals().order_by("id"))
+    totals = CartTotalsSerializer(cart.totals())
+    return {"lines": serializer.data, **totals.data}
+
+
+class CartSummaryView(APIView):
+    def get(self, request, format=None):
+        return Response(get_cart_summary(request), status=status.HTTP_200_OK)
+
+
+class CartBatchView(APIView):
+    """
+    Add, set or remove many cart lines at once, from a list of
+    ``{slug, op, quantity}``, and return the resulting cart summary.
+    """
+
+    max_items = 500
+    retries = 3
+
+    def post(self, request, format=None):
+        serializer = CartOperationSerializer(
+            data=request.data, many=True, allow_empty=False, max_length=self.max_items
+        )
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        operations = serializer.validated_data
+
+        products = dict(
+            Product.objects.filter(
+                slug__in=[operation["slug"] for operation in operations]
+            ).values_list("slug", "pk")
+        )
+        errors = [
+            {} if operation["slug"] in products else {"slug": ["Product not found."]}
+            for operation in operations
+        ]
+        if any(errors):
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        operations = [
+            (operation["op"], products[operation["slug"]], operation.get("quantity"))
+            for operation in operations
+        ]
+        for attempt in range(self.retries):
+            try:
+                with transaction.atomic():
+                    Cart.objects.apply(request.user, operations, products.values())
+                break
+            except IntegrityError:
+                # a concurrent add created one of the new lines first
+                if attempt == self.retries - 1:
+                    raise
+
+        return Response(get_cart_summary(request), status=status.HTTP_200_OK)
+
+
+class CheckoutView(APIView):
+    """
+    Place an order for everything in the user's cart.
+    """
+
+    def post(self, request, format=None):
+        try:
+            order = checkout(request.user)
+        except CheckoutError as error:
+            return Response(error.detail, status=status.HTTP_400_BAD_REQUEST)
+
+        order = Order.objects.prefetch_related("items__product").get(pk=order.pk)
+        serializer = OrderSerializer(order)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
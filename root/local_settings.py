@@ -15,3 +15,6 @@ SIMPLE_JWT.update({"ACCESS_TOKEN_LIFETIME": timedelta(days=30)})
 
 
 EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
+
+# the development server runs in a single process
+SILENCED_SYSTEM_CHECKS = ["products.W001"]
@@ -45,6 +45,7 @@ INSTALLED_APPS = [
     # my apps
     "accounts.apps.AccountsConfig",
     "products.apps.ProductsConfig",
+    "outbox.apps.OutboxConfig",
     # third party
     "corsheaders",
     "rest_framework",
@@ -100,6 +101,27 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# cache versions, ETags and the breadcrumb map are shared through the
+# cache, so with more than one worker process CACHE_BACKEND must be a
+# shared cache like Redis or Memcached, see the products.W001 check
+CACHES = {
+    "default": {
+        "BACKEND": CONFIG.get("CACHE_BACKEND")
+        or "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": CONFIG.get("CACHE_LOCATION") or "",
+    }
+}
+
+# seconds a cache version lives; a per-process cache never sees the bumps
+# of other workers, so its versions expire soon to let them converge
+CACHE_VERSION_TIMEOUT = CONFIG.get("CACHE_VERSION_TIMEOUT") or (
+    60 * 5 if CACHES["default"]["BACKEND"].endswith(".LocMemCache") else 60 * 60 * 24
+)
+
+
 AUTH_USER_MODEL = "accounts.User"
 
 
@@ -182,6 +204,27 @@ DEFAULT_FROM_EMAIL = CONFIG.get("DEFAULT_FROM_EMAIL")
 EMAIL_VERIFY_TIMEOUT = 180  # in seconds
 
 
+# stock alerts: with STOCK_DIGEST, sellers get one email per
+# STOCK_DIGEST_WINDOW seconds listing products out of stack or at most
+# LOW_STOCK_THRESHOLD left, instead of an email per product out of stack
+STOCK_DIGEST = CONFIG.get("STOCK_DIGEST") or False
+STOCK_DIGEST_WINDOW = CONFIG.get("STOCK_DIGEST_WINDOW") or 3600  # in seconds
+LOW_STOCK_THRESHOLD = CONFIG.get("LOW_STOCK_THRESHOLD") or 0
+
+
+# celery configurations
+# without a broker, queued emails are sent by `manage.py send_outbox --loop`
+CELERY_BROKER_URL = CONFIG.get("CELERY_BROKER_URL")
+CELERY_BEAT_SCHEDULE = {
+    # retries emails that failed or were queued while the broker was down
+    "send-outbox": {"task": "outbox.tasks.send_outbox_task", "schedule": 60},
+    "send-stock-digests": {
+        "task": "products.tasks.send_stock_digests_task",
+        "schedule": STOCK_DIGEST_WINDOW,
+    },
+}
+
+
 CLIENT_URL = CONFIG.get("CLIENT_URL")
 
 
@@ -0,0 +1,31 @@
+from itertools import islice
+
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import JSONRenderer
+
+
+def stream_json_list(serializer, rows, chunk_size):
+    """
+    Render ``rows`` with the ``many=True`` ``serializer`` as a JSON array,
+    ``chunk_size`` rows at a time, so only one chunk is held in memory.
+    """
+    renderer = JSONRenderer()
+    rows = iter(rows)
+    separator = b""
+
+    yield b"["
+    while chunk := list(islice(rows, chunk_size)):
+        data = renderer.render(serializer.to_representation(chunk))
+        yield separator + data[1:-1]
+        separator = b","
+    yield b"]"
+
+
+class StreamingJSONListResponse(StreamingHttpResponse):
+    def __init__(self, serializer, queryset, chunk_size=2000, **kwargs):
+        rows = queryset.iterator(chunk_size=chunk_size)
+        super().__init__(
+            stream_json_list(serializer, rows, chunk_size),
+            content_type="application/json",
+            **kwargs,
+        )
@@ -0,0 +1,37 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudgetMixin:
+    """
+    Test case mixin asserting that an endpoint's query count does not grow
+    with the number of rows it returns.
+    """
+
+    def assertQueriesDoNotScale(self, request, add_rows, budget=None):
+        """
+        Call ``request`` before and after ``add_rows`` and fail unless both
+        calls ran the same number of queries, at most ``budget`` if given.
+        ``request`` should already return some rows.
+        """
+        # warm up per-process caches so they don't skew the first count
+        request()
+
+        with CaptureQueriesContext(connection) as before:
+            request()
+        add_rows()
+        with CaptureQueriesContext(connection) as after:
+            request()
+
+        queries = "\n".join(query["sql"] for query in after.captured_queries)
+        self.assertEqual(
+            len(before),
+            len(after),
+            f"Query count grew from {len(before)} to {len(after)}:\n{queries}",
+        )
+        if budget is not None:
+            self.assertLessEqual(
+                len(after),
+                budget,
+                f"{len(after)} queries exceed the budget of {budget}:\n{queries}",
+            )